@@ -1,62 +1,86 @@
 #agent.py
+import logging
 import networkx as nx
 from mesa import Agent
 import math
+from map_compiler import DIRECTIONS
+from profiling import count, phase
+
+logger = logging.getLogger(__name__)
 
 def heuristic(a, b):
     (x1, y1) = a
     (x2, y2) = b
     return math.sqrt((x1 - x2)**2 + (y1 - y2)**2)
 
+class CostOverlay:
+    """
+    Car specific edge costs layered over the shared city graph.
+    The graph itself is never copied, so cars always route against the
+    current traffic light weights.
+    """
+    __slots__ = ("extra",)
+
+    def __init__(self):
+        self.extra = None  # (u, v) -> added cost, only allocated when used
+
+    def set_cost(self, u, v, cost):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[(u, v)] = cost
+
+    def clear(self):
+        self.extra = None
+
 class Car(Agent):
     """
     Car agent that can find paths using A* algorithm.
     """
-    def __init__(self, unique_id, model, start, destination, graph):
+    def __init__(self, unique_id, model, start, destination, overlay):
         super().__init__(unique_id, model)
         self.start = start
-        self.graph = graph
+        self.overlay = overlay
         self.destination = destination
-        print(f"Car {self.unique_id} created with start {self.start} and destination {self.destination}")
+        logger.debug("Car %s created with start %s and destination %s", self.unique_id, self.start, self.destination)
         self.path = []
         self.arrived = False
         self.steps_stopped = 0
+        self.route_epoch = model.route_epoch
+
+    def plan_path(self):
+        # Cars without costs of their own use the model's precomputed routes
+        with phase(self.model.profiler, "pathfinding"):
+            if self.overlay.extra is None and self.model.routes.covers(self.destination):
+                return self.model.routes.path(self.start, self.destination)
+            return self.model.graph.astar_path(self.start, self.destination, self.overlay.extra)
 
     def find_path(self):
-        # Directly access the graph
-        G = self.model.G
-        print(G)
         try:
-            self.path = nx.astar_path(self.graph, self.start, self.destination, heuristic)
-            print(f"Car {self.unique_id} found path from {self.start} to {self.destination}")
+            self.path = self.plan_path()
+            logger.debug("Car %s found path from %s to %s", self.unique_id, self.start, self.destination)
         except nx.NetworkXNoPath:
-            print(f"No path found for {self.unique_id} from {self.start} to {self.destination}")
+            logger.debug("No path found for %s from %s to %s", self.unique_id, self.start, self.destination)
             self.path = []
 
     def move(self):
         # Get cell in front of the car
-        directions = {'Up': (0, 1), 'Down': (0, -1), 'Left': (-1, 0), 'Right': (1, 0)}
+        model = self.model
         direction = self.get_direction()
         if direction:
-            dx, dy = directions[direction]
+            dx, dy = DIRECTIONS[direction]
             front_x, front_y = self.pos[0] + dx, self.pos[1] + dy
-            # Ensure next_cell is a list, even if empty
-            next_cell = self.model.grid.get_cell_list_contents([(front_x, front_y)]) if self.model.valid_position(front_x, front_y) else []
-        else:
-            # If there's no direction, set next_cell as an empty list
-            next_cell = []
-
-        # Check if the next cell is a traffic light or another car
-        if any(isinstance(obj, Traffic_Light) and not obj.state for obj in next_cell) or any(isinstance(obj, Car) for obj in next_cell):
-            return  # Stop the car
+            # Stop at a red light or behind another car, both read from the model's cell arrays
+            if model.valid_position(front_x, front_y) and (model.is_occupied(front_x, front_y)
+                                                           or model.is_red_light(front_x, front_y)):
+                return
 
+        next_step = self.pos
         if self.path:
             next_step = self.path.pop(0)
-            self.model.grid.move_agent(self, next_step)
+            model.move_car(self, next_step)
             if self.pos == self.destination:
-                print(f"Car {self.unique_id} has reached its destination.")
-                self.model.schedule.remove(self)
-                self.model.grid.remove_agent(self)
+                logger.debug("Car %s has reached its destination.", self.unique_id)
+                model.remove_car(self)
                 self.model.active_agents -= 1
                 self.model.arrived_agents += 1
                 self.arrived = True
@@ -71,17 +95,15 @@ class Car(Agent):
 
 
         # Checamos si hay mas de 3 carros en frente
-        neighborhood_three = self.model.grid.get_neighborhood(self.pos, moore=False, include_center=False, radius=3)
         if direction:
-            dx, dy = directions[direction]
             front_three_x = [self.pos[0] + dx, self.pos[0] + 2*dx, self.pos[0] + 3*dx]
             front_three_y = [self.pos[1] + dy, self.pos[1] + 2*dy, self.pos[1] + 3*dy]
             valid_positions = [(x,y) for x,y in zip(front_three_x, front_three_y) if self.model.valid_position(x,y)]
-            next_three_cells = [self.model.grid.get_cell_list_contents(pos) for pos in valid_positions]
-
-            next_three_cells_occupied = [any([isinstance(c, Car)]) for cell in next_three_cells for c in cell]
-            if all(next_three_cells_occupied):
-                print(next_three_cells_occupied)
+            # Every valid cell ahead used to hold a road, light or destination
+            # agent that counted as "not a car", so this only fires when there
+            # is no road ahead. Checked on the cells so it does not depend on
+            # the model having static agents.
+            if not valid_positions:
                 if direction == 'Up':
                     lane_change_step = (self.pos[0] - 1, self.pos[1])
                 elif direction == 'Down':
@@ -109,12 +131,11 @@ class Car(Agent):
             if destination:
                 self.destination = destination
 
-            # Ensure that the car uses its own graph for recalculating the path
             try:
-                self.path = nx.astar_path(self.graph, self.start, self.destination, heuristic)
-                print(f"Car {self.unique_id} recalculated path from {self.start} to {self.destination}")
+                self.path = self.plan_path()
+                logger.debug("Car %s recalculated path from %s to %s", self.unique_id, self.start, self.destination)
             except nx.NetworkXNoPath:
-                print(f"No path could be recalculated for {self.unique_id} from {self.start} to {self.destination}")
+                logger.debug("No path could be recalculated for %s from %s to %s", self.unique_id, self.start, self.destination)
                 self.path = []
 
     def get_direction(self):
@@ -131,10 +152,26 @@ class Car(Agent):
             elif dy == -1:
                 return 'Down'
 
+    def reroute(self):
+        # Switch to the model's current routes from where the car is, keeping
+        # the old path if there is none. Unlike recalculate_path the car
+        # doesn't spend a step on its own cell.
+        self.route_epoch = self.model.route_epoch
+        if not self.path:
+            return
+        self.start = self.pos
+        try:
+            self.path = self.plan_path()[1:]
+        except nx.NetworkXNoPath:
+            pass
+
     def step(self):
+        if self.route_epoch != self.model.route_epoch:
+            self.reroute()
         if not self.path:
             self.find_path()
-        self.move()
+        with phase(self.model.profiler, "movement"):
+            self.move()
 
 class Traffic_Light(Agent):
     """
@@ -155,13 +192,18 @@ class Traffic_Light(Agent):
         self.direction = None
 
 
+    def toggle(self):
+        self.state = not self.state
+        count(self.model.profiler, "light_toggles")
+        self.model.update_graph_edge_weights(self)
+
     def step(self):
         """
         To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
+        CityModel doesn't schedule its lights, its LightScheduler calls toggle.
         """
         if self.model.schedule.steps % self.timeToChange == 0:
-            self.state = not self.state
-            self.model.update_graph_edge_weights(self)
+            self.toggle()
 
 class Destination(Agent):
     """
@@ -183,6 +225,19 @@ class Obstacle(Agent):
     def step(self):
         pass
 
+class StaticCell:
+    """
+    Road, obstacle or destination cell of a model built with
+    static_agents=False. The model keeps those cells in its arrays only,
+    these are made on demand, e.g. to draw them.
+    """
+    __slots__ = ("kind", "pos", "direction")
+
+    def __init__(self, kind, pos, direction=None):
+        self.kind = kind  # "road", "obstacle" or "destination"
+        self.pos = pos
+        self.direction = direction
+
 class Road(Agent):
     """
     Road agent. Determines where the cars can move, and in which direction.
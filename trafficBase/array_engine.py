@@ -0,0 +1,295 @@
+#array_engine.py
+import networkx as nx
+import numpy as np
+
+from profiling import phase
+
+
+class ArrayCarEngine:
+    """
+    Optional car engine for headless runs, CityModel(N, engine="array").
+    Cars are rows in NumPy arrays instead of Mesa agents and a whole tick is
+    resolved in bulk. Every tick the cars get a random order, like
+    RandomActivation, and a car moves only if its front cell is free at its
+    turn, so the result is the same as stepping them one by one.
+    Traffic lights are toggled by the model before the cars move.
+
+    The partitioned engine runs one of these per tile: `owned` marks the
+    cells of the tile and `external` counts the cars of the other tiles per
+    cell. Cars heading out of the tile don't move in step(), they are left
+    in `requests` for the owner of the cell to accept with settle_requests.
+    """
+    def __init__(self, model, capacity=1024, seed=None):
+        self.model = model
+        self.height = model.height
+        self.cells = model.width * model.height
+        self.stop_limit = 10  # Blocked steps before a car plans again
+
+        self.size = 0  # Rows in use, active or not
+        self.numbers = np.zeros(capacity, dtype=np.int64)  # "car_<number>"
+        self.x = np.zeros(capacity, dtype=np.int32)
+        self.y = np.zeros(capacity, dtype=np.int32)
+        self.destination = np.zeros(capacity, dtype=np.int32)  # Cell id
+        self.active = np.zeros(capacity, dtype=bool)
+        self.steps_stopped = np.zeros(capacity, dtype=np.int32)
+
+        # Paths of all the cars, one after the other, as cell ids. A car
+        # follows path_cells[cursor:path_end] and planning again appends.
+        self.path_cells = np.zeros(capacity * 16, dtype=np.int32)
+        self.path_used = 0
+        self.cursor = np.zeros(capacity, dtype=np.int64)
+        self.path_end = np.zeros(capacity, dtype=np.int64)
+
+        self.light_cells = np.array([self.cell(*light.pos) for light in model.traffic_lights], dtype=np.int64)
+        self.red = np.zeros(self.cells, dtype=bool)
+        self.cell_of_node = None  # Cell id by graph node id, see node_cells
+        self.rng = np.random.default_rng(model.random.getrandbits(64) if seed is None else seed)
+
+        self.owned = None  # Cells of the tile, None when the engine has the whole grid
+        self.external = None
+        self.requests = np.zeros(0, dtype=np.int64)  # Rows waiting to leave the tile
+
+    def cell(self, x, y):
+        return x * self.height + y
+
+    def __len__(self):
+        return int(self.active[:self.size].sum())
+
+    def add_car(self, number, start, destination):
+        self.add_cars([number], [start], [destination])
+
+    def add_cars(self, numbers, starts, destinations):
+        """
+        Add a batch of cars, numbers are the ones in their "car_<number>" id.
+        """
+        rows = self.new_rows(len(numbers))
+        self.numbers[rows] = numbers
+        self.x[rows] = [start[0] for start in starts]
+        self.y[rows] = [start[1] for start in starts]
+        self.destination[rows] = [self.cell(*destination) for destination in destinations]
+        self.plan_rows(rows)
+
+    def adopt_car(self, number, cell, destination, path):
+        """
+        Takes over a car from another tile, on `cell` and with the rest of
+        its path, all as cell ids.
+        """
+        row = self.new_rows(1)[0]
+        self.numbers[row] = number
+        self.x[row], self.y[row] = divmod(cell, self.height)
+        self.destination[row] = destination
+        self.store_path(row, path)
+
+    def new_rows(self, count):
+        if self.size + count > len(self.active):
+            self.compact()
+        if self.size + count > len(self.active):
+            self.grow(max(2 * len(self.active), self.size + count))
+        rows = np.arange(self.size, self.size + count)
+        self.size += count
+        self.active[rows] = True
+        self.steps_stopped[rows] = 0
+        return rows
+
+    def grow(self, capacity):
+        for name in ("numbers", "x", "y", "destination", "active", "steps_stopped", "cursor", "path_end"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def compact(self):
+        # Drop the rows of arrived cars and the path segments nobody follows anymore
+        keep = np.flatnonzero(self.active[:self.size])
+        for name in ("numbers", "x", "y", "destination", "active", "steps_stopped"):
+            values = getattr(self, name)
+            values[:len(keep)] = values[keep]
+        segments = [self.path_cells[self.cursor[row]:self.path_end[row]] for row in keep]
+        lengths = np.array([len(segment) for segment in segments], dtype=np.int64)
+        self.path_end[:len(keep)] = np.cumsum(lengths)
+        self.cursor[:len(keep)] = self.path_end[:len(keep)] - lengths
+        self.path_used = int(lengths.sum())
+        if segments:
+            self.path_cells[:self.path_used] = np.concatenate(segments)
+        self.active[len(keep):self.size] = False
+        self.size = len(keep)
+
+    def plan(self, row):
+        """
+        Path from the car's cell to its destination, through the model's routes.
+        """
+        start = (int(self.x[row]), int(self.y[row]))
+        destination = divmod(int(self.destination[row]), self.height)
+        try:
+            with phase(self.model.profiler, "pathfinding"):
+                path = self.model.routes.path(start, destination)
+        except (nx.NetworkXNoPath, nx.NodeNotFound, KeyError):
+            path = []
+        self.store_path(row, [self.cell(x, y) for x, y in path])
+
+    def plan_rows(self, rows):
+        """
+        plan() for a batch of new cars, cars that share their start and
+        destination share a lookup and each destination's tree is walked
+        once for all its starts.
+        """
+        if len(rows) == 1:
+            self.plan(rows[0])
+            return
+        routes = self.model.routes
+        starts = self.x[rows].astype(np.int64) * self.height + self.y[rows]
+        pairs, pair_of_row = np.unique(np.stack([self.destination[rows], starts], axis=1), axis=0, return_inverse=True)
+        paths = [None] * len(pairs)
+        for destination in np.unique(pairs[:, 0]).tolist():
+            indices = np.flatnonzero(pairs[:, 0] == destination)
+            try:
+                with phase(self.model.profiler, "pathfinding"):
+                    found = routes.node_paths([divmod(int(cell), self.height) for cell in pairs[indices, 1]],
+                                              divmod(destination, self.height))
+            except (nx.NodeNotFound, KeyError):
+                continue
+            for index, nodes in zip(indices.tolist(), found):
+                if nodes is not None:
+                    paths[index] = self.node_cells(nodes)
+        for row, pair in zip(rows.tolist(), pair_of_row.ravel().tolist()):
+            self.store_path(row, paths[pair] if paths[pair] is not None else [])
+
+    def node_cells(self, nodes):
+        # Graph node ids -> cell ids
+        if self.cell_of_node is None:
+            xy = np.array(self.model.routes.graph.nodes, dtype=np.int64).reshape(-1, 2)
+            self.cell_of_node = xy[:, 0] * self.height + xy[:, 1]
+        return self.cell_of_node[nodes]
+
+    def reroute(self):
+        # Every car with a path takes the current route from its cell, the
+        # old path stays if there is none
+        for row in np.flatnonzero(self.active[:self.size] & (self.cursor[:self.size] < self.path_end[:self.size])):
+            start = (int(self.x[row]), int(self.y[row]))
+            destination = divmod(int(self.destination[row]), self.height)
+            try:
+                with phase(self.model.profiler, "pathfinding"):
+                    path = self.model.routes.path(start, destination)[1:]
+            except (nx.NetworkXNoPath, nx.NodeNotFound, KeyError):
+                continue
+            self.store_path(row, [self.cell(x, y) for x, y in path])
+
+    def occupancy(self):
+        rows = np.flatnonzero(self.active[:self.size])
+        cells = self.x[rows].astype(np.int64) * self.height + self.y[rows]
+        return np.bincount(cells, minlength=self.cells).reshape(self.model.width, self.height)
+
+    def store_path(self, row, path):
+        if self.path_used + len(path) > len(self.path_cells):
+            cells = np.zeros(2 * (self.path_used + len(path)), dtype=np.int32)
+            cells[:self.path_used] = self.path_cells[:self.path_used]
+            self.path_cells = cells
+        self.path_cells[self.path_used:self.path_used + len(path)] = path
+        self.cursor[row] = self.path_used
+        self.path_used += len(path)
+        self.path_end[row] = self.path_used
+
+    def step(self):
+        size = self.size
+        rows = np.flatnonzero(self.active[:size])
+        # Cars without a path try to find one, like Car.step
+        for row in rows[self.cursor[rows] >= self.path_end[rows]]:
+            self.plan(row)
+        size = self.size
+        rows = np.flatnonzero(self.active[:size] & (self.cursor[:size] < self.path_end[:size]))
+        n = len(rows)
+        if n == 0:
+            return
+
+        self.red[:] = False
+        self.red[self.light_cells] = [not light.state for light in self.model.traffic_lights]
+
+        x, y = self.x[rows], self.y[rows]
+        here = x.astype(np.int64) * self.height + y
+        target = self.path_cells[self.cursor[rows]].astype(np.int64)
+        tx, ty = np.divmod(target, self.height)
+
+        # Front cell from the first step of the path, same rules as Car.get_direction
+        dx, dy = tx - x, ty - y
+        fx = np.where(dx != 0, x + np.sign(dx), x)
+        fy = np.where(dx != 0, y, y + np.sign(dy))
+        has_front = ((np.abs(dx) == 1) | ((dx == 0) & (np.abs(dy) == 1)))
+        has_front &= (fx >= 0) & (fx < self.model.width) & (fy >= 0) & (fy < self.height)
+        front = np.where(has_front, fx * self.height + fy, 0)
+        has_front &= self.model.passable.ravel()[front]
+        front = np.where(has_front, front, -1)
+
+        light_blocked = has_front & self.red[np.maximum(front, 0)]
+        arrives = target == self.destination[rows]
+        travels = target != here  # Stepping onto its own cell leaves occupancy alone
+
+        all_rows = np.flatnonzero(self.active[:size])
+        occupancy = np.bincount(self.x[all_rows].astype(np.int64) * self.height + self.y[all_rows], minlength=self.cells)
+        held = light_blocked
+        if self.owned is not None:
+            occupancy = occupancy + self.external
+            held = light_blocked | ~self.owned[target]
+
+        # A car's turn only depends on the cars before it in the order, so
+        # starting from "everybody moves" this settles in at most n rounds
+        rank = self.rng.permutation(n)
+        moved = ~held
+        free = np.ones(n, dtype=bool)
+        for _ in range(n):
+            leaves = moved & travels
+            enters = leaves & ~arrives
+            left = self.count_before(here[leaves], rank[leaves], front, rank, n)
+            entered = self.count_before(target[enters], rank[enters], front, rank, n)
+            free = (front < 0) | (occupancy[np.maximum(front, 0)] - left + entered <= 0)
+            new_moved = ~held & free
+            if np.array_equal(new_moved, moved):
+                break
+            moved = new_moved
+
+        moving = rows[moved]
+        self.x[moving] = tx[moved]
+        self.y[moving] = ty[moved]
+        self.cursor[moving] += 1
+        self.steps_stopped[moving] = 0
+
+        done = rows[moved & arrives]
+        self.active[done] = False
+        self.model.active_agents -= len(done)
+        self.model.arrived_agents += len(done)
+
+        # Cars that could leave the tile wait for settle_requests
+        requested = held & ~light_blocked & free
+        self.requests = rows[requested]
+        self.stopped(rows[~moved & ~requested])
+        if len(self.requests) == 0:
+            self.compact_if_sparse()
+
+    def settle_requests(self, accepted):
+        # The accepted cars are in another tile now, the others stay stopped
+        self.active[self.requests[accepted]] = False
+        self.stopped(self.requests[~accepted])
+        self.requests = self.requests[:0]
+        self.compact_if_sparse()
+
+    def stopped(self, stuck):
+        self.steps_stopped[stuck] += 1
+        for row in stuck[self.steps_stopped[stuck] > self.stop_limit]:
+            self.steps_stopped[row] = 0
+            self.plan(row)
+
+    def compact_if_sparse(self):
+        if (self.size > 64 and len(self) < self.size // 2) or self.path_used > len(self.path_cells) * 3 // 4:
+            self.compact()
+
+    def count_before(self, cells, ranks, query_cells, query_ranks, n):
+        # For every query, how many of (cells, ranks) are on its cell with a lower rank
+        keys = np.sort(cells * n + ranks)
+        base = query_cells * n
+        return np.searchsorted(keys, base + query_ranks) - np.searchsorted(keys, base)
+
+    def get_agent_data(self):
+        rows = np.flatnonzero(self.active[:self.size])
+        return [
+            {"id": f"car_{number}", "x": x, "y": y, "arrived": False}
+            for number, x, y in zip(self.numbers[rows].tolist(), self.x[rows].tolist(), self.y[rows].tolist())
+        ]
@@ -0,0 +1,136 @@
+#asgi_server.py
+# Asynchronous server for the Unity client, the endpoints of flask_server.py
+# the viewer polls: /init, /update, /getAgents, /getSemaphores,
+# /getObstacles, /metrics and /close. Every session's model steps on its own
+# ModelWorker thread, reads are answered from the worker's latest snapshot
+# without waiting for a tick, and /update waits for the tick it asked for
+# without holding up other requests.
+#
+#   python asgi_server.py                 # or: uvicorn asgi_server:app --port 8585
+#
+# Needs starlette and uvicorn, and python-multipart for multipart form posts.
+# Run a single server process, the sessions live in its memory.
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from model_worker import ModelWorker
+from sessions import DEFAULT_SESSION, InitError, SessionRegistry, build_model
+
+# Sessions the registry drops, when replaced, removed or evicted during a
+# lookup, are closed off the event loop: closing joins their worker thread,
+# which may be in the middle of a tick
+closing = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-close")
+sessions = SessionRegistry(closer=lambda session: closing.submit(session.close))
+
+logger = logging.getLogger(__name__)
+
+
+async def request_values(request):
+    # Query and form parameters together, like Flask's request.values
+    values = dict(request.query_params)
+    if request.method == "POST":
+        content_type = request.headers.get("content-type", "")
+        if content_type.startswith("multipart/form-data"):
+            values.update(await request.form())
+        else:
+            values.update(parse_qsl((await request.body()).decode()))
+    return values
+
+
+def json_bytes(body):
+    return Response(body, media_type="application/json")
+
+
+def no_session():
+    return JSONResponse({'message': 'Model not initiated, call /init first.'}, status_code=404)
+
+
+def open_session(model, session_id=DEFAULT_SESSION):
+    return sessions.create(model, session_id, ModelWorker(model))
+
+
+async def get_worker(request):
+    values = await request_values(request)
+    session = sessions.get(values.get('session', DEFAULT_SESSION))
+    return values, session, session.worker if session is not None else None
+
+
+async def initModel(request):
+    values = await request_values(request)
+    logger.info("Init with %s agents", values.get('NAgents', 10))
+    # `new=1` always opens a new session instead of replacing one
+    session_id = None if values.get('new') == '1' else values.get('session', DEFAULT_SESSION)
+    try:
+        model = await run_in_threadpool(build_model, values)
+    except InitError as error:
+        return JSONResponse({'message': str(error)}, status_code=error.status)
+    session = await run_in_threadpool(open_session, model, session_id)
+    return JSONResponse({"message": "Parameters recieved, model initiated.", "session": session.id,
+                         "currentStep": session.worker.snapshot.step})
+
+
+async def updateModel(request):
+    """
+    Waits for `steps` (1 by default) steps after the current snapshot.
+    Updates asked for while a tick runs share the ticks they need.
+    """
+    values, session, worker = await get_worker(request)
+    if worker is None: return no_session()
+    if not sessions.has_car_budget(session.id):
+        return JSONResponse({'message': 'Server car limit reached, try again later.'}, status_code=503)
+    snapshot = await worker.request_steps(asyncio.get_running_loop(), int(values.get('steps', 1)))
+    return JSONResponse({'message': f'Model updated to step {snapshot.step}.', 'currentStep': snapshot.step})
+
+
+async def getAgents(request):
+    _, _, worker = await get_worker(request)
+    if worker is None: return no_session()
+    return json_bytes(worker.snapshot.agents)
+
+
+async def getSemaphores(request):
+    _, _, worker = await get_worker(request)
+    if worker is None: return no_session()
+    return json_bytes(worker.snapshot.semaphores)
+
+
+async def getObstacles(request):
+    return JSONResponse({'positions': []})
+
+
+async def getMetrics(request):
+    _, _, worker = await get_worker(request)
+    if worker is None: return no_session()
+    return json_bytes(worker.snapshot.metrics)
+
+
+async def closeSession(request):
+    values = await request_values(request)
+    closed = sessions.remove(values.get('session', DEFAULT_SESSION))
+    return JSONResponse({'message': 'Session closed.' if closed else 'No such session.'})
+
+
+app = Starlette(routes=[
+    Route('/init', initModel, methods=['GET', 'POST']),
+    Route('/update', updateModel, methods=['GET']),
+    Route('/getAgents', getAgents, methods=['GET']),
+    Route('/getSemaphores', getSemaphores, methods=['GET']),
+    Route('/getObstacles', getObstacles, methods=['GET']),
+    Route('/metrics', getMetrics, methods=['GET']),
+    Route('/close', closeSession, methods=['GET', 'POST']),
+])
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    uvicorn.run(app, host="localhost", port=8585)
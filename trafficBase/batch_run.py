@@ -0,0 +1,103 @@
+#batch_run.py
+# Headless parameter sweeps of CityModel over a process pool.
+#
+#   python batch_run.py --maps 2022_base 2023_base --spawn-every 1 3 \
+#       --light-times 15:7 10:5 --seeds 0 1 2 --steps 1000 --out sweep.json
+#
+# Run from trafficBase/ like the servers, the maps are read from city_files/.
+# Every combination of the grid is one run, the results file holds one list
+# per column with a row per run.
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from model import CityModel
+
+COLUMNS = ["map", "spawn_every", "light_S", "light_s", "light_plan", "demand", "congestion_every", "seed", "engine", "steps", "cars_spawned",
+           "arrived_agents", "active_agents", "throughput", "seconds", "ticks_per_second", "profile"]
+
+
+def parse_light_times(value):
+    # "15:7" -> {"S": 15, "s": 7}
+    slow, fast = value.split(":")
+    return {"S": int(slow), "s": int(fast)}
+
+
+def run_one(params):
+    map_name, spawn_every, light_times, light_plan, demand, congestion_every, seed, steps, engine, profile = params
+    model = CityModel(1, engine=engine, map_file=os.path.join('city_files', map_name + '.txt'),
+                      spawn_every=spawn_every, light_times=light_times, max_steps=steps, report=False,
+                      static_agents=False, profile=profile, congestion_every=congestion_every or None,
+                      light_plan=None if light_plan == "fixed" else light_plan,
+                      demand=None if demand == "none" else os.path.join('city_files', 'demand', demand + '.json'),
+                      seed=seed)
+    start = time.perf_counter()
+    while model.running:
+        model.step()
+    seconds = time.perf_counter() - start
+    ticks = model.schedule.steps
+    return {
+        "map": map_name,
+        "spawn_every": spawn_every,
+        "light_S": light_times["S"],
+        "light_s": light_times["s"],
+        "light_plan": light_plan,
+        "demand": demand,
+        "congestion_every": congestion_every,
+        "seed": seed,
+        "engine": engine,
+        "steps": ticks,
+        "cars_spawned": model.num_cars,
+        "arrived_agents": model.arrived_agents,
+        "active_agents": model.active_agents,
+        "throughput": model.arrived_agents / ticks if ticks else 0.0,
+        "seconds": seconds,
+        "ticks_per_second": ticks / seconds if seconds else 0.0,
+        "profile": model.profiler.snapshot() if profile else None,
+    }
+
+
+def build_grid(args):
+    light_times = [parse_light_times(value) for value in args.light_times]
+    return list(itertools.product(args.maps, args.spawn_every, light_times, args.light_plans, args.demand,
+                                  args.congestion_every, args.seeds, [args.steps], [args.engine], [args.profile]))
+
+
+def to_columns(rows):
+    return {column: [row[column] for row in rows] for column in COLUMNS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a grid of CityModel configurations in parallel.")
+    parser.add_argument("--maps", nargs="+", default=["2023_base"], help="map names in city_files/, without .txt")
+    parser.add_argument("--spawn-every", nargs="+", type=int, default=[3], help="steps between spawned cars")
+    parser.add_argument("--light-times", nargs="+", default=["15:7"], help="'S:s' steps between light changes")
+    parser.add_argument("--light-plans", nargs="+", default=["fixed"],
+                        help="light plans of the map dictionary, 'fixed' for the plain timings")
+    parser.add_argument("--demand", nargs="+", default=["none"],
+                        help="demand files of city_files/demand/, 'none' to spawn at the corners every --spawn-every")
+    parser.add_argument("--congestion-every", nargs="+", type=int, default=[0],
+                        help="steps between congestion route updates, 0 for none")
+    parser.add_argument("--seeds", nargs="+", type=int, default=[0])
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--engine", choices=["mesa", "array"], default="mesa")
+    parser.add_argument("--profile", action="store_true", help="time the phases of each run's steps")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--out", default="batch_results.json")
+    args = parser.parse_args()
+
+    grid = build_grid(args)
+    print(f"{len(grid)} runs on {args.workers} workers")
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        rows = list(pool.map(run_one, grid))
+
+    with open(args.out, "w") as out:
+        json.dump(to_columns(rows), out)
+    print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+# Benchmarks of the simulation, run from trafficBase/:
+#
+#   python -m benchmarks run --out before.json
+#   python -m benchmarks compare before.json after.json
+#
+# Each module also runs on its own, e.g. python benchmarks/routing.py.
+#   construction  CityModel construction and map compilation per map
+#   throughput    ticks per second at several car counts, per engine
+#   scaling       partitioned engine ticks per second against its workers
+#   spawning      batch spawning with shared route lookups against one by one
+#   routing       A* and destination trees, CSR against networkx, and zone routing trees
+#   light_updates cost of applying a step's light toggles to the graph
+#   car_memory    memory per car
+#   latency       /update and /getAgents through the Flask test client
+#   read_latency  reads while the model steps, flask_server against asgi_server
+# Scaled up maps are 2023_base tiled n x n, see maps.py.
@@ -0,0 +1,114 @@
+# python -m benchmarks run [--quick] [--only routing ...] --out results.json
+# python -m benchmarks compare before.json after.json
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import networkx as nx
+import numpy as np
+
+from benchmarks import (car_memory, construction, latency, light_updates, read_latency, routing, scaling, spawning,
+                        throughput)
+
+# name -> (run, full sizes, --quick sizes)
+SUITES = {
+    "construction": (construction.run, {}, {"tiles": [2], "repeats": 1}),
+    "throughput": (throughput.run, {}, {"tiles": 2, "cars": [100, 500], "ticks": 10}),
+    "scaling": (scaling.run, {}, {"tiles": 2, "workers": [1, 2], "cars": 500, "ticks": 5}),
+    "spawning": (spawning.run, {}, {"tiles": 2, "batches": [100], "rounds": 2}),
+    "routing": (routing.run, {}, {"tiles": [2], "queries": 50}),
+    "light_updates": (light_updates.run, {}, {"tiles": [2], "rounds": 5}),
+    "car_memory": (car_memory.run, {}, {"cars": [1000], "copy_limit": 100}),
+    "latency": (latency.run, {}, {"requests": 50, "warmup": 50}),
+    "read_latency": (read_latency.run, {}, {"tiles": 2, "cars": 500, "requests": 50}),
+}
+# Metrics where a larger value is an improvement, for compare
+HIGHER_IS_BETTER = ("per_second",)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suites(names, quick):
+    results = {}
+    for name in names:
+        run, full, small = SUITES[name]
+        print(f"running {name}", file=sys.stderr)
+        results[name] = run(**(small if quick else full))
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "quick": quick,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "networkx": nx.__version__,
+        },
+        "results": results,
+    }
+
+
+def flatten(results, prefix=""):
+    # {"routing": {"2023_base": {"astar_csr_s": 0.1}}} -> {"routing/2023_base/astar_csr_s": 0.1}
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}/"))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare(before, after, threshold):
+    old, new = flatten(before["results"]), flatten(after["results"])
+    print(f"before {before['meta']['commit']} ({before['meta']['date']}), "
+          f"after {after['meta']['commit']} ({after['meta']['date']})")
+    print(f"{'metric':<64} {'before':>12} {'after':>12} {'change':>8}")
+    for key in sorted(old.keys() & new.keys()):
+        if old[key] == 0:
+            continue
+        change = new[key] / old[key] - 1
+        better = change > 0 if key.endswith(HIGHER_IS_BETTER) else change < 0
+        flag = "" if abs(change) < threshold else (" better" if better else " WORSE")
+        print(f"{key:<64} {old[key]:>12.4g} {new[key]:>12.4g} {change:>+8.1%}{flag}")
+    for key in sorted(old.keys() ^ new.keys()):
+        print(f"{key:<64} only in {'before' if key in old else 'after'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Simulation benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks and write their results")
+    run_parser.add_argument("--only", nargs="+", choices=list(SUITES), default=list(SUITES))
+    run_parser.add_argument("--quick", action="store_true", help="small sizes, for a smoke test")
+    run_parser.add_argument("--out", default="benchmark_results.json")
+    compare_parser = commands.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="flag changes larger than this share")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_suites(args.only, args.quick)
+        with open(args.out, "w") as out:
+            json.dump(results, out, indent=1)
+        print(f"Results written to {args.out}")
+    else:
+        with open(args.before) as before, open(args.after) as after:
+            compare(json.load(before), json.load(after), args.threshold)
+
+
+if __name__ == "__main__":
+    main()
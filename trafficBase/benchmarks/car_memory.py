@@ -0,0 +1,72 @@
+# Memory per spawned car: a full G.copy() per car (the old behaviour) against
+# the shared graph with a CostOverlay per car.
+#
+#   python benchmarks/car_memory.py --cars 1000 10000
+#
+# Run from trafficBase/, the model loads the maps with relative paths.
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent import Car
+from model import CityModel
+
+
+def measure(model, n_cars, copy_graph):
+    gc.collect()
+    tracemalloc.start()
+    cars = []
+    start = model.destinations[0]
+    for i in range(n_cars):
+        overlay = model.generate_overlay_for_car(f"bench_{i}")
+        car = Car(f"bench_{i}", model, start, model.destinations[-1], overlay)
+        if copy_graph:
+            car.graph = model.G.copy()
+        cars.append(car)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del cars
+    gc.collect()
+    return current
+
+
+def run(cars=(1000, 10000), copy_limit=1000):
+    """
+    Bytes per car for each count in cars, G.copy() figures above copy_limit
+    are extrapolated from copy_limit cars.
+    """
+    model = CityModel(1, report=False)
+    results = {}
+    per_copy = None
+    for n in cars:
+        shared = measure(model, n, copy_graph=False)
+        extrapolated = n > copy_limit
+        if not extrapolated:
+            per_copy = measure(model, n, copy_graph=True) / n
+        elif per_copy is None:
+            per_copy = measure(model, copy_limit, copy_graph=True) / copy_limit
+        results[f"{n}_cars"] = {"overlay_bytes_per_car": shared / n, "copy_bytes_per_car": per_copy,
+                                "copy_extrapolated": extrapolated}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-car memory of graph copies and cost overlays.")
+    parser.add_argument("--cars", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--copy-limit", type=int, default=1000,
+                        help="above this many cars the G.copy() figure is extrapolated instead of allocated")
+    args = parser.parse_args()
+
+    print(f"{'cars':>8} {'overlay MB':>12} {'per car B':>10} {'G.copy MB':>12} {'per car B':>10}")
+    for n, (label, result) in zip(args.cars, run(args.cars, args.copy_limit).items()):
+        shared, copied = result["overlay_bytes_per_car"], result["copy_bytes_per_car"]
+        note = " (extrapolated)" if result["copy_extrapolated"] else ""
+        print(f"{n:>8} {shared * n / 1e6:>12.2f} {shared:>10.0f} {copied * n / 1e6:>12.2f} {copied:>10.0f}{note}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# CityModel construction time per map in city_files/ and per tiled map, with
+# the compiled map cached (the normal case) and the compile step on its own.
+#
+#   python benchmarks/construction.py --tiles 2 4 --repeats 3
+#
+# Run from trafficBase/, the model loads the maps with relative paths.
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.maps import tile_map
+from map_compiler import compile_map, load_map
+from model import CityModel
+
+
+def best_of(repeats, function):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_map(map_file, repeats):
+    dictionary = json.load(open(os.path.join('city_files', 'mapDictionary.json')))
+    with open(map_file) as baseFile:
+        lines = baseFile.readlines()
+    load_map(map_file, dictionary)  # Make sure the artifact is cached
+    return {
+        "compile_s": best_of(repeats, lambda: compile_map(lines, dictionary)),
+        "construct_s": best_of(repeats, lambda: CityModel(1, map_file=map_file, report=False)),
+        "construct_no_static_agents_s": best_of(
+            repeats, lambda: CityModel(1, map_file=map_file, report=False, static_agents=False)),
+    }
+
+
+def run(tiles=(2, 4), repeats=3):
+    maps = {os.path.splitext(os.path.basename(path))[0]: path
+            for path in sorted(glob.glob(os.path.join('city_files', '*.txt')))}
+    for n in tiles:
+        maps[f"2023_base_{n}x{n}"] = tile_map(n, n)
+    return {label: benchmark_map(path, repeats) for label, path in maps.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time CityModel construction per map.")
+    parser.add_argument("--tiles", type=int, nargs="*", default=[2, 4], help="n for n x n tilings of 2023_base")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'map':>20} {'compile ms':>11} {'construct ms':>13} {'no static ms':>13}")
+    for label, result in run(args.tiles, args.repeats).items():
+        print(f"{label:>20} {result['compile_s'] * 1e3:>11.1f} {result['construct_s'] * 1e3:>13.1f} "
+              f"{result['construct_no_static_agents_s'] * 1e3:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# Latency of /update and /getAgents through the Flask test client, with the
+# default session warmed up to a few cars first.
+#
+#   python benchmarks/latency.py --requests 200 --warmup 150
+#
+# Run from trafficBase/, the model loads the maps with relative paths.
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flask_server
+from sessions import DEFAULT_SESSION, build_model
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(int(share * len(values)), len(values) - 1)]
+
+
+def timings(client, path, requests):
+    times = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get(path)
+        times.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.status_code
+    return {"mean_ms": 1000 * sum(times) / len(times), "p50_ms": 1000 * percentile(times, 0.5),
+            "p95_ms": 1000 * percentile(times, 0.95)}
+
+
+def run(requests=200, warmup=150):
+    client = flask_server.app.test_client()
+    # The model /init would build, without reporting to the class API
+    flask_server.sessions.create(build_model({'NAgents': '1'}, report=False), DEFAULT_SESSION)
+    for _ in range(warmup):
+        client.get('/update')
+    results = {"/update": timings(client, '/update', requests), "/getAgents": timings(client, '/getAgents', requests)}
+    flask_server.sessions.remove(DEFAULT_SESSION)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the Flask endpoints the Unity client polls.")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=150, help="steps taken before timing")
+    args = parser.parse_args()
+
+    print(f"{'endpoint':>12} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for endpoint, result in run(args.requests, args.warmup).items():
+        print(f"{endpoint:>12} {result['mean_ms']:>8.3f} {result['p50_ms']:>8.3f} {result['p95_ms']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Cost of applying light toggles to the road graph: every light toggles and
+# CityModel.flush_edge_weight_updates rewrites the edges into them and drops
+# the affected route trees, with the trees of every destination built.
+#
+#   python benchmarks/light_updates.py --tiles 2 4 --rounds 20
+#
+# Run from trafficBase/, the model loads the maps with relative paths.
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.maps import tile_map
+from model import CityModel
+
+
+def benchmark(map_file, rounds):
+    model = CityModel(1, map_file=map_file, report=False, static_agents=False)
+    seconds = 0.0
+    for _ in range(rounds):
+        for destination in model.destinations:
+            model.routes.tree(destination)
+        start = time.perf_counter()
+        for light in model.traffic_lights:
+            light.state = not light.state
+            model.update_graph_edge_weights(light)
+        model.flush_edge_weight_updates()
+        seconds += time.perf_counter() - start
+    return {"lights": len(model.traffic_lights), "ms_per_update": 1000 * seconds / rounds,
+            "us_per_light": 1e6 * seconds / rounds / max(len(model.traffic_lights), 1)}
+
+
+def run(tiles=(2, 4), rounds=20):
+    maps = {"2023_base": os.path.join('city_files', '2023_base.txt')}
+    for n in tiles:
+        maps[f"2023_base_{n}x{n}"] = tile_map(n, n)
+    return {label: benchmark(path, rounds) for label, path in maps.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time graph updates after light toggles.")
+    parser.add_argument("--tiles", type=int, nargs="*", default=[2, 4], help="n for n x n tilings of 2023_base")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'map':>20} {'lights':>7} {'ms/update':>10} {'us/light':>9}")
+    for label, result in run(args.tiles, args.rounds).items():
+        print(f"{label:>20} {result['lights']:>7} {result['ms_per_update']:>10.3f} {result['us_per_light']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
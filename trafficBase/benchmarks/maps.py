@@ -0,0 +1,22 @@
+# Synthetic city maps for the benchmarks, made by tiling a bundled map.
+import os
+import tempfile
+
+BASE_MAP = os.path.join('city_files', '2023_base.txt')
+
+
+def tile_map(tiles_x, tiles_y, base_map=BASE_MAP, out_dir=None):
+    """
+    Writes base_map repeated tiles_x times across and tiles_y times down and
+    returns the path of the new map file.
+    """
+    with open(base_map) as baseFile:
+        rows = [line.strip() for line in baseFile if line.strip()]
+    tiled = [row * tiles_x for row in rows] * tiles_y
+    out_dir = out_dir or os.path.join(tempfile.gettempdir(), 'traffic_maps')
+    os.makedirs(out_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(base_map))[0]
+    path = os.path.join(out_dir, f'{name}_{tiles_x}x{tiles_y}.txt')
+    with open(path, 'w') as out:
+        out.write('\n'.join(tiled) + '\n')
+    return path
@@ -0,0 +1,120 @@
+# Latency of /getSemaphores while another client keeps calling /update, on
+# a model whose ticks are slow, for flask_server.py (the model steps on the
+# request thread) and asgi_server.py (the model steps on a worker thread).
+# Both servers run in this process on a local port.
+#
+#   python benchmarks/read_latency.py --tiles 4 --cars 4000 --requests 200
+#
+# Run from trafficBase/, the model loads the maps with relative paths.
+import argparse
+import logging
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+from werkzeug.serving import make_server
+
+import asgi_server
+import flask_server
+from benchmarks.latency import percentile
+from benchmarks.maps import tile_map
+from benchmarks.throughput import populate
+from model import CityModel
+from sessions import DEFAULT_SESSION
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_flask(port):
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", port, flask_server.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
+
+
+def start_asgi(port):
+    server = uvicorn.Server(uvicorn.Config(asgi_server.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+    return stop
+
+
+def make_model(map_file, n_cars, seed):
+    model = CityModel(1, engine="mesa", map_file=map_file, max_steps=10**9, report=False,
+                      static_agents=False, seed=seed)
+    populate(model, n_cars, random.Random(seed))
+    return model
+
+
+def benchmark(server, model, requests):
+    port = free_port()
+    if server == "flask":
+        stop = start_flask(port)
+        flask_server.sessions.create(model, DEFAULT_SESSION)
+    else:
+        stop = start_asgi(port)
+        asgi_server.open_session(model)
+    base = f"http://127.0.0.1:{port}"
+    updating = threading.Event()
+    updating.set()
+    ticks = []
+
+    def update():
+        while updating.is_set():
+            start = time.perf_counter()
+            urllib.request.urlopen(base + "/update").read()
+            ticks.append(time.perf_counter() - start)
+
+    updater = threading.Thread(target=update, daemon=True)
+    updater.start()
+    times = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        urllib.request.urlopen(base + "/getSemaphores").read()
+        times.append(time.perf_counter() - start)
+    updating.clear()
+    updater.join()
+    stop()
+    (flask_server.sessions if server == "flask" else asgi_server.sessions).remove(DEFAULT_SESSION)
+    return {"read_mean_ms": 1000 * sum(times) / len(times), "read_p50_ms": 1000 * percentile(times, 0.5),
+            "read_p95_ms": 1000 * percentile(times, 0.95), "update_mean_ms": 1000 * sum(ticks) / max(len(ticks), 1)}
+
+
+def run(tiles=4, cars=4000, servers=("flask", "asgi"), requests=200, seed=0):
+    map_file = tile_map(tiles, tiles)
+    return {f"2023_base_{tiles}x{tiles}/{cars}_cars/{server}": benchmark(server, make_model(map_file, cars, seed), requests)
+            for server in servers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time reads while the model steps, Flask against ASGI.")
+    parser.add_argument("--tiles", type=int, default=4, help="n for an n x n tiling of 2023_base")
+    parser.add_argument("--cars", type=int, default=4000, help="cars on the road, more make slower ticks")
+    parser.add_argument("--servers", nargs="+", choices=["flask", "asgi"], default=["flask", "asgi"])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'run':>34} {'read mean':>10} {'read p50':>9} {'read p95':>9} {'update ms':>10}")
+    for label, result in run(args.tiles, args.cars, args.servers, args.requests, args.seed).items():
+        print(f"{label:>34} {result['read_mean_ms']:>10.2f} {result['read_p50_ms']:>9.2f} "
+              f"{result['read_p95_ms']:>9.2f} {result['update_mean_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# A* and destination tree times of the CSR graph backend against networkx,
+# on the bundled maps and on tiled copies of 2023_base, and the trees of
+# zone routing (routes.ZoneRouteService) with the time its tables take.
+#
+#   python benchmarks/routing.py --tiles 2 4 8 --queries 200
+#
+# Run from trafficBase/, the model loads the maps with relative paths.
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import networkx as nx
+
+from benchmarks.maps import tile_map
+from graph_backend import NetworkXBackend
+from model import CityModel
+from routes import ZoneRouteService
+
+BUNDLED_MAPS = ['2021_base', '2022_base', '2023_base']
+
+
+def time_queries(query, pairs):
+    start = time.perf_counter()
+    for source, target in pairs:
+        try:
+            query(source, target)
+        except nx.NetworkXNoPath:
+            pass
+    return (time.perf_counter() - start) / len(pairs)
+
+
+def benchmark_map(map_file, queries, trees, rng):
+    model = CityModel(1, map_file=map_file, report=False, static_agents=False, graph_backend="csr")
+    csr = model.graph
+    networkx = NetworkXBackend(model.G)
+    nodes = list(model.G.nodes)
+    pairs = [(rng.choice(nodes), rng.choice(model.destinations)) for _ in range(queries)]
+    destinations = model.destinations[:trees]
+
+    astar_nx = time_queries(networkx.astar_path, pairs)
+    astar_csr = time_queries(csr.astar_path, pairs)
+    tree_nx = time_queries(lambda d, _: networkx.reverse_tree(d), [(d, None) for d in destinations])
+    tree_csr = time_queries(lambda d, _: csr.reverse_tree(d), [(d, None) for d in destinations])
+    zones = ZoneRouteService(csr, model.destinations, [light.pos for light in model.traffic_lights])
+    start = time.perf_counter()
+    zones.build_tables()
+    zone_tables = time.perf_counter() - start
+    tree_zones = time_queries(lambda d, _: zones.zone_tree(d), [(d, None) for d in destinations])
+    return {"nodes": len(nodes), "astar_networkx_s": astar_nx, "astar_csr_s": astar_csr,
+            "astar_csr_per_second": 1 / astar_csr, "tree_networkx_s": tree_nx, "tree_csr_s": tree_csr,
+            "tree_zones_s": tree_zones, "zone_tables_s": zone_tables}
+
+
+def run(tiles=(2, 4, 8), queries=200, trees=5, seed=0):
+    rng = random.Random(seed)
+    results = {}
+    for name in BUNDLED_MAPS:
+        results[name] = benchmark_map(os.path.join('city_files', name + '.txt'), queries, trees, rng)
+    for n in tiles:
+        label = f"2023_base_{n}x{n}"
+        results[label] = benchmark_map(tile_map(n, n), queries, trees, rng)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the CSR and networkx routing backends.")
+    parser.add_argument("--tiles", type=int, nargs="*", default=[2, 4, 8], help="n for n x n tilings of 2023_base")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--trees", type=int, default=5, help="destination trees built per map")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'map':>16} {'nodes':>8} {'A* nx ms':>10} {'A* csr ms':>10} {'speedup':>8}"
+          f" {'tree nx ms':>10} {'tree csr ms':>10} {'speedup':>8} {'zones ms':>9} {'speedup':>8} {'tables s':>9}")
+    for label, r in run(args.tiles, args.queries, args.trees, args.seed).items():
+        print(f"{label:>16} {r['nodes']:>8} {r['astar_networkx_s'] * 1e3:>10.3f} {r['astar_csr_s'] * 1e3:>10.3f}"
+              f" {r['astar_networkx_s'] / r['astar_csr_s']:>7.1f}x {r['tree_networkx_s'] * 1e3:>10.2f}"
+              f" {r['tree_csr_s'] * 1e3:>10.2f} {r['tree_networkx_s'] / r['tree_csr_s']:>7.1f}x"
+              f" {r['tree_zones_s'] * 1e3:>9.2f} {r['tree_csr_s'] / r['tree_zones_s']:>7.1f}x {r['zone_tables_s']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
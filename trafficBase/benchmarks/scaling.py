@@ -0,0 +1,65 @@
+# Ticks per second of the partitioned engine against its number of workers,
+# on 2023_base tiled n x n with cars spread over the whole map.
+#
+#   python benchmarks/scaling.py --tiles 4 --workers 1 2 4 8 --cars 8000
+#
+# Run from trafficBase/, the model loads the maps with relative paths.
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.maps import tile_map
+from benchmarks.throughput import populate
+from model import CityModel
+
+
+def benchmark(map_file, workers, n_cars, ticks, warmup, seed):
+    model = CityModel(1, engine="partitioned", workers=workers, map_file=map_file, max_steps=10**9, report=False,
+                      static_agents=False, seed=seed)
+    try:
+        populate(model, n_cars, random.Random(seed))
+        for _ in range(warmup):
+            model.step()
+        start = time.perf_counter()
+        for _ in range(ticks):
+            model.step()
+        seconds = time.perf_counter() - start
+        return {"ticks_per_second": ticks / seconds, "ms_per_tick": 1000 * seconds / ticks,
+                "active_cars": model.active_agents}
+    finally:
+        model.close()
+
+
+def run(tiles=4, workers=(1, 2, 4, 8), cars=8000, ticks=20, warmup=5, seed=0):
+    map_file = tile_map(tiles, tiles)
+    results = {}
+    for count in workers:
+        result = benchmark(map_file, count, cars, ticks, warmup, seed)
+        result["speedup"] = results[f"{workers[0]}_workers"]["ms_per_tick"] / result["ms_per_tick"] if results else 1.0
+        results[f"{count}_workers"] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how the partitioned engine scales with workers.")
+    parser.add_argument("--tiles", type=int, default=4, help="n for an n x n tiling of 2023_base")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--cars", type=int, default=8000)
+    parser.add_argument("--ticks", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'ticks/s':>9} {'ms/tick':>9} {'speedup':>8} {'cars':>6}")
+    for label, result in run(args.tiles, args.workers, args.cars, args.ticks, args.warmup, args.seed).items():
+        print(f"{label.split('_')[0]:>8} {result['ticks_per_second']:>9.1f} {result['ms_per_tick']:>9.2f} "
+              f"{result['speedup']:>7.2f}x {result['active_cars']:>6}")
+
+
+if __name__ == "__main__":
+    main()
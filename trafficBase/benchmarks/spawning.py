@@ -0,0 +1,65 @@
+# Cost of spawning cars with their first path: CityModel.add_cars with a
+# whole batch against the same cars added one at a time, per engine, with
+# the route trees of the destinations already built.
+#
+#   python benchmarks/spawning.py --tiles 4 --batch 100 1000
+#
+# Run from trafficBase/, the model loads the maps with relative paths.
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.maps import tile_map
+from model import CityModel
+
+
+def benchmark(map_file, engine, batch, rounds, seed):
+    model = CityModel(1, engine=engine, map_file=map_file, report=False, static_agents=False, seed=seed)
+    rng = random.Random(seed)
+    roads = [node for node in model.graph.nodes if model.is_road(*node)]
+    targets = rng.sample(model.destinations, min(16, len(model.destinations)))
+    for destination in targets:
+        model.routes.tree(destination)
+    batches = [([rng.choice(roads) for _ in range(batch)], [rng.choice(targets) for _ in range(batch)])
+               for _ in range(rounds)]
+    seconds = {"batch": 0.0, "single": 0.0}
+    for starts, destinations in batches:
+        start = time.perf_counter()
+        model.add_cars(starts, destinations)
+        seconds["batch"] += time.perf_counter() - start
+        start = time.perf_counter()
+        for car in zip(starts, destinations):
+            model.add_cars([car[0]], [car[1]])
+        seconds["single"] += time.perf_counter() - start
+    cars = batch * rounds
+    return {"batch_cars_per_second": cars / seconds["batch"], "single_cars_per_second": cars / seconds["single"],
+            "speedup": seconds["single"] / seconds["batch"]}
+
+
+def run(tiles=4, batches=(100, 1000), engines=("mesa", "array"), rounds=5, seed=0):
+    map_file = tile_map(tiles, tiles)
+    return {f"2023_base_{tiles}x{tiles}/{batch}_per_batch/{engine}": benchmark(map_file, engine, batch, rounds, seed)
+            for engine in engines for batch in batches}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure batch spawning against one car at a time.")
+    parser.add_argument("--tiles", type=int, default=4, help="n for an n x n tiling of 2023_base")
+    parser.add_argument("--batch", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--engines", nargs="+", choices=["mesa", "array"], default=["mesa", "array"])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'run':>40} {'batch cars/s':>13} {'single cars/s':>14} {'speedup':>8}")
+    for label, result in run(args.tiles, args.batch, args.engines, args.rounds, args.seed).items():
+        print(f"{label:>40} {result['batch_cars_per_second']:>13.0f} {result['single_cars_per_second']:>14.0f} "
+              f"{result['speedup']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
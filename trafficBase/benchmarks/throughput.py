@@ -0,0 +1,78 @@
+# Ticks per second of CityModel.step with a given number of cars on the road,
+# for both car engines, on 2023_base tiled n x n.
+#
+#   python benchmarks/throughput.py --tiles 4 --cars 100 1000 4000 --ticks 20
+#
+# Run from trafficBase/, the model loads the maps with relative paths.
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent import Car
+from benchmarks.maps import tile_map
+from model import CityModel
+
+
+def populate(model, n_cars, rng, n_destinations=16):
+    """
+    Puts n_cars cars on distinct random road cells, heading to a few random
+    destinations so the route trees stay comparable between map sizes.
+    """
+    roads = [node for node in model.graph.nodes if model.is_road(*node)]
+    starts = rng.sample(roads, n_cars)
+    targets = rng.sample(model.destinations, min(n_destinations, len(model.destinations)))
+    destinations = [rng.choice(targets) for _ in starts]
+    numbers = list(range(model.car_id_counter, model.car_id_counter + n_cars))
+    if model.engine is not None:
+        model.engine.add_cars(numbers, starts, destinations)
+    else:
+        for number, start, destination in zip(numbers, starts, destinations):
+            car_id = "car_" + str(number)
+            car = Car(car_id, model, start, destination, model.generate_overlay_for_car(car_id))
+            model.place_car(car, start)
+    model.car_id_counter += n_cars
+    model.num_cars += n_cars
+    model.active_agents += n_cars
+
+
+def benchmark(map_file, engine, n_cars, ticks, warmup, seed):
+    model = CityModel(1, engine=engine, map_file=map_file, max_steps=10**9, report=False,
+                      static_agents=False, seed=seed)
+    populate(model, n_cars, random.Random(seed))
+    for _ in range(warmup):
+        model.step()
+    start = time.perf_counter()
+    for _ in range(ticks):
+        model.step()
+    seconds = time.perf_counter() - start
+    return {"ticks_per_second": ticks / seconds, "ms_per_tick": 1000 * seconds / ticks,
+            "active_cars": model.active_agents}
+
+
+def run(tiles=4, cars=(100, 1000, 4000), engines=("mesa", "array"), ticks=20, warmup=5, seed=0):
+    map_file = tile_map(tiles, tiles)
+    return {f"2023_base_{tiles}x{tiles}/{n_cars}_cars/{engine}": benchmark(map_file, engine, n_cars, ticks, warmup, seed)
+            for engine in engines for n_cars in cars}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure CityModel ticks per second.")
+    parser.add_argument("--tiles", type=int, default=4, help="n for an n x n tiling of 2023_base")
+    parser.add_argument("--cars", type=int, nargs="+", default=[100, 1000, 4000])
+    parser.add_argument("--engines", nargs="+", choices=["mesa", "array"], default=["mesa", "array"])
+    parser.add_argument("--ticks", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'run':>32} {'ticks/s':>9} {'ms/tick':>9} {'cars':>6}")
+    for label, result in run(args.tiles, args.cars, args.engines, args.ticks, args.warmup, args.seed).items():
+        print(f"{label:>32} {result['ticks_per_second']:>9.1f} {result['ms_per_tick']:>9.2f} {result['active_cars']:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#checkpoint.py
+# Save a running CityModel to a single compressed .npz file and restore it to
+# continue exactly where it stopped, for warm starts and replays.
+#
+#   save_checkpoint(model, 'checkpoints/congested_800.npz')
+#   model = load_checkpoint('checkpoints/congested_800.npz', report=False)
+#
+# The file holds the model's constructor parameters, the random number
+# generator states, the lights, the route trees and the cars, either the
+# Mesa agents or the rows of the array engine. Static cells and the graph
+# are rebuilt from the map, which must not have changed since the save.
+import json
+
+import numpy as np
+
+from agent import Car
+
+FORMAT_VERSION = 2  # 2: lights fired by the LightScheduler
+ENGINE_ARRAYS = ("numbers", "x", "y", "destination", "active", "steps_stopped", "cursor", "path_end")
+
+
+class CheckpointError(ValueError):
+    pass
+
+
+def save_checkpoint(model, path):
+    if model.params["engine"] == "partitioned":
+        raise CheckpointError("Models on the partitioned engine can't be checkpointed, use engine='array'")
+    meta = {
+        "version": FORMAT_VERSION,
+        "params": model.params,
+        "map_key": model.compiled_map.key,
+        "steps": model.schedule.steps,
+        "time": model.schedule.time,
+        "running": model.running,
+        "num_cars": model.num_cars,
+        "active_agents": model.active_agents,
+        "arrived_agents": model.arrived_agents,
+        "car_id_counter": model.car_id_counter,
+    }
+    version, mt_state, gauss_next = model.random.getstate()
+    meta["random"] = {"version": version, "gauss_next": gauss_next}
+    arrays = {
+        "random_state": np.array(mt_state, dtype=np.uint32),
+        "light_states": np.array([light.state for light in model.traffic_lights], dtype=bool),
+    }
+
+    # Route trees as they are, a rebuilt tree could break cost ties differently
+    trees = list(model.routes.trees.items())
+    arrays["tree_destinations"] = np.array([destination for destination, _ in trees], dtype=np.int32).reshape(-1, 2)
+    arrays["tree_next_hop"] = np.array([tree[0] for _, tree in trees], dtype=np.int32).reshape(len(trees), -1)
+    arrays["tree_distance"] = np.array([tree[1] for _, tree in trees], dtype=np.float64).reshape(len(trees), -1)
+    meta["route_builds"] = model.routes.builds
+    meta["route_epoch"] = model.route_epoch
+    if model.congestion is not None:
+        arrays["congestion_estimate"] = model.congestion.estimate
+    if model.edge_penalty is not None:
+        arrays["edge_penalty"] = model.edge_penalty
+    if model.demand is not None:
+        meta["demand_rng"] = model.demand.rng.bit_generator.state
+
+    if model.engine is not None:
+        engine = model.engine
+        meta["engine"] = {"size": engine.size, "capacity": len(engine.active), "path_used": engine.path_used,
+                          "path_capacity": len(engine.path_cells), "rng": engine.rng.bit_generator.state}
+        for name in ENGINE_ARRAYS:
+            arrays["engine_" + name] = getattr(engine, name)[:engine.size]
+        arrays["engine_path_cells"] = engine.path_cells[:engine.path_used]
+    else:
+        # Cars in schedule order, RandomActivation shuffles in that order
+        cars = [agent for agent in model.schedule.agents if isinstance(agent, Car)]
+        paths = [car.path for car in cars]
+        arrays["car_numbers"] = np.array([int(car.unique_id.split("_")[1]) for car in cars], dtype=np.int64)
+        arrays["car_cells"] = np.array([(car.pos, car.start, car.destination) for car in cars],
+                                       dtype=np.int32).reshape(-1, 3, 2)
+        arrays["car_steps_stopped"] = np.array([car.steps_stopped for car in cars], dtype=np.int32)
+        arrays["car_route_epochs"] = np.array([car.route_epoch for car in cars], dtype=np.int64)
+        arrays["car_path_ends"] = np.cumsum([len(path) for path in paths], dtype=np.int64)
+        arrays["car_paths"] = np.array([cell for path in paths for cell in path], dtype=np.int32).reshape(-1, 2)
+        meta["overlays"] = {str(i): [[u, v, cost] for (u, v), cost in car.overlay.extra.items()]
+                            for i, car in enumerate(cars) if car.overlay.extra is not None}
+
+    arrays["meta"] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+    np.savez_compressed(path, **arrays)
+
+
+def load_checkpoint(path, **overrides):
+    """
+    CityModel in the state it was saved in. Keyword arguments are passed to
+    CityModel and override the saved parameters, e.g. report or metrics.
+    """
+    from model import CityModel
+
+    with np.load(path, allow_pickle=False) as data:
+        arrays = {name: data[name] for name in data.files}
+    meta = json.loads(arrays.pop("meta").tobytes())
+    if meta["version"] != FORMAT_VERSION:
+        raise CheckpointError(f"Checkpoint format {meta['version']} is not supported, expected {FORMAT_VERSION}")
+
+    model = CityModel(**{**meta["params"], **overrides})
+    if model.compiled_map.key != meta["map_key"]:
+        raise CheckpointError(f"The map {meta['params']['map_file']} changed since the checkpoint was saved")
+
+    model.schedule.steps = meta["steps"]
+    model.schedule.time = meta["time"]
+    model.light_scheduler.reset(meta["steps"])
+    model.running = meta["running"]
+    for name in ("num_cars", "active_agents", "arrived_agents", "car_id_counter"):
+        setattr(model, name, meta[name])
+    model.random.setstate((meta["random"]["version"], tuple(arrays["random_state"].tolist()),
+                           meta["random"]["gauss_next"]))
+
+    for light, state in zip(model.traffic_lights, arrays["light_states"].tolist()):
+        light.state = state
+    if "edge_penalty" in arrays:
+        model.edge_penalty = arrays["edge_penalty"]
+    if "congestion_estimate" in arrays:
+        model.congestion.estimate[...] = arrays["congestion_estimate"]
+    model.route_epoch = meta["route_epoch"]
+    if "demand_rng" in meta:
+        model.demand.rng.bit_generator.state = meta["demand_rng"]
+    model.reweight_edges()
+    model.routes.invalidate()
+    for destination, next_hop, distance in zip(arrays["tree_destinations"].tolist(), arrays["tree_next_hop"].tolist(),
+                                               arrays["tree_distance"].tolist()):
+        model.routes.trees[tuple(destination)] = (next_hop, distance)
+    model.routes.builds = meta["route_builds"]
+
+    if model.engine is not None:
+        restore_engine(model.engine, meta["engine"], arrays)
+    else:
+        restore_cars(model, meta, arrays)
+    return model
+
+
+def restore_engine(engine, state, arrays):
+    engine.grow(state["capacity"])
+    for name in ENGINE_ARRAYS:
+        getattr(engine, name)[:state["size"]] = arrays["engine_" + name]
+    engine.size = state["size"]
+    engine.path_cells = np.zeros(state["path_capacity"], dtype=np.int32)
+    engine.path_cells[:state["path_used"]] = arrays["engine_path_cells"]
+    engine.path_used = state["path_used"]
+    engine.rng.bit_generator.state = state["rng"]
+
+
+def restore_cars(model, meta, arrays):
+    overlays = meta["overlays"]
+    starts = np.concatenate([[0], arrays["car_path_ends"][:-1]]).tolist() if len(arrays["car_path_ends"]) else []
+    paths = [tuple(cell) for cell in arrays["car_paths"].tolist()]
+    for i, (number, cells, steps_stopped, route_epoch, start, end) in enumerate(zip(
+            arrays["car_numbers"].tolist(), arrays["car_cells"].tolist(), arrays["car_steps_stopped"].tolist(),
+            arrays["car_route_epochs"].tolist(), starts, arrays["car_path_ends"].tolist())):
+        pos, car_start, destination = (tuple(cell) for cell in cells)
+        car_id = "car_" + str(number)
+        car = Car(car_id, model, car_start, destination, model.generate_overlay_for_car(car_id))
+        for u, v, cost in overlays.get(str(i), []):
+            car.overlay.set_cost(tuple(u), tuple(v), cost)
+        car.path = paths[start:end]
+        car.steps_stopped = steps_stopped
+        car.route_epoch = route_epoch
+        model.place_car(car, pos)
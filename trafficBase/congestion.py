@@ -0,0 +1,31 @@
+#congestion.py
+# Congestion-aware routing, CityModel(N, congestion_every=K).
+# The model feeds the cars per cell into a CongestionField every step. Every
+# K steps the field's estimate becomes an extra cost on the edges into each
+# cell, the route trees are rebuilt against it and all cars re-route by
+# looking up their destination's tree.
+import numpy as np
+
+
+class CongestionField:
+    """
+    Rolling estimate of the cars on each cell, an exponential moving average
+    of the occupancy with the given decay per step. An edge into a cell
+    costs `weight` times that estimate on top of its light weight.
+    """
+    def __init__(self, width, height, every=10, weight=2.0, decay=0.9):
+        self.every = every
+        self.weight = weight
+        self.decay = decay
+        self.estimate = np.zeros((width, height), dtype=np.float64)
+
+    def observe(self, occupancy):
+        self.estimate *= self.decay
+        self.estimate += (1 - self.decay) * occupancy
+
+    def due(self, step):
+        return step % self.every == 0
+
+    def penalties(self):
+        # Rounded so tiny differences don't reshuffle equal routes
+        return np.round(self.weight * self.estimate, 2)
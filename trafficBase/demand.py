@@ -0,0 +1,109 @@
+#demand.py
+# Time-varying traffic demand, CityModel(N, demand='city_files/demand/rush_hour.json').
+# Instead of one car at a corner every `spawn_every` steps, every step spawns
+# a batch drawn from origin-destination matrices between zones:
+#
+#   {"zones": {"west": [[0, 0, 0, 24]], "depot": [[5, 3]]},
+#    "periods": [{"start": 0, "rate": 2, "od": {"corners": {"all": 1}}},
+#                {"start": 300, "rate": 12, "od": {"west": {"all": 3}, "depot": {"west": 1}}}],
+#    "cycle": 600}
+#
+# A zone is a list of cells [x, y] and inclusive rectangles [x0, y0, x1, y1].
+# Cars start on the road cells of the origin zone and head to the
+# destination cells of the destination zone. "all" is the whole map and
+# "corners" the four corner cells place_single_car uses. A period holds from
+# its `start` step until the next one; `rate` is the mean number of cars per
+# step and the matrix weighs the origin-destination pairs. With `cycle` the
+# periods repeat every that many steps.
+import json
+
+import numpy as np
+
+from map_compiler import DESTINATION, ROAD
+
+
+class DemandProfile:
+    """
+    Demand file with the spawn cells of its zones worked out once for the
+    model's map. spawns(step) draws the cars of a step from `rng`.
+    """
+    def __init__(self, spec, model, rng):
+        self.rng = rng
+        self.cycle = spec.get("cycle")
+        zones = dict(spec.get("zones", {}))
+        zones.setdefault("all", [[0, 0, model.width - 1, model.height - 1]])
+        zones.setdefault("corners", [[0, 0], [model.width - 1, 0], [0, model.height - 1],
+                                     [model.width - 1, model.height - 1]])
+        cells = {name: self.zone_cells(name, zone, model.width, model.height) for name, zone in zones.items()}
+        self.periods = []  # (start, rate, origin cells, destination cells, pair weights)
+        for period in sorted(spec["periods"], key=lambda period: period["start"]):
+            origins, destinations, weights = [], [], []
+            for origin, row in period["od"].items():
+                for destination, weight in row.items():
+                    origin_cells = self.cells_of(cells, origin, model.cell_types, ROAD)
+                    destination_cells = self.cells_of(cells, destination, model.cell_types, DESTINATION)
+                    origins.append(origin_cells)
+                    destinations.append(destination_cells)
+                    weights.append(float(weight))
+            weights = np.array(weights)
+            if not len(weights) or weights.sum() <= 0:
+                raise ValueError(f"The demand period starting at {period['start']} has no positive weights")
+            self.periods.append((period["start"], float(period["rate"]), origins, destinations,
+                                 weights / weights.sum()))
+        self.starts = [period[0] for period in self.periods]
+
+    @classmethod
+    def load(cls, path, model, rng):
+        with open(path) as file:
+            return cls(json.load(file), model, rng)
+
+    @staticmethod
+    def zone_cells(name, zone, width, height):
+        cells = []
+        for area in zone:
+            if len(area) == 2:
+                area = [area[0], area[1], area[0], area[1]]
+            x0, y0, x1, y1 = area
+            if not (0 <= x0 <= x1 < width and 0 <= y0 <= y1 < height):
+                raise ValueError(f"Zone {name!r} has {area}, outside the {width}x{height} map")
+            xs, ys = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1), indexing="ij")
+            cells.append(np.stack([xs.ravel(), ys.ravel()], axis=1))
+        return np.unique(np.concatenate(cells), axis=0) if cells else np.zeros((0, 2), dtype=np.int64)
+
+    @staticmethod
+    def cells_of(cells, name, cell_types, cell_type):
+        # Cells of the zone that are of cell_type, e.g. its roads for origins
+        if name not in cells:
+            raise ValueError(f"Unknown demand zone {name!r}, the zones are {sorted(cells)}")
+        zone = cells[name]
+        found = zone[cell_types[zone[:, 0], zone[:, 1]] == cell_type]
+        if not len(found):
+            kind = "road" if cell_type == ROAD else "destination"
+            raise ValueError(f"Demand zone {name!r} has no {kind} cells")
+        return found
+
+    def period(self, step):
+        if self.cycle:
+            step %= self.cycle
+        index = np.searchsorted(self.starts, step, side="right") - 1
+        return self.periods[index] if index >= 0 else None
+
+    def spawns(self, step):
+        """
+        (starts, destinations) of the cars spawning on `step`, as lists of
+        (x, y) tuples.
+        """
+        period = self.period(step)
+        if period is None:
+            return [], []
+        _, rate, origins, destinations, weights = period
+        per_pair = self.rng.multinomial(self.rng.poisson(rate), weights)
+        starts, ends = [], []
+        for pair in np.flatnonzero(per_pair).tolist():
+            n = int(per_pair[pair])
+            starts.append(origins[pair][self.rng.integers(len(origins[pair]), size=n)])
+            ends.append(destinations[pair][self.rng.integers(len(destinations[pair]), size=n)])
+        if not starts:
+            return [], []
+        return [tuple(cell) for cell in np.concatenate(starts).tolist()], \
+            [tuple(cell) for cell in np.concatenate(ends).tolist()]
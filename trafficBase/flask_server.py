@@ -2,71 +2,207 @@
 # Python flask server to interact with Unity. Based on the code provided by Sergio Ruiz.
 # Octavio Navarro. October 2023git
 
-from flask import Flask, request, jsonify
+import logging
+import os
+
+from flask import Flask, Response, request, jsonify
 from model import *
 from agent import *
 from model import CityModel
-citymodel = None
+from checkpoint import save_checkpoint
+from sessions import CHECKPOINT_DIR, DEFAULT_SESSION, InitError, SessionRegistry, build_model, checkpoint_path
+from streaming import FrameStream
+from trajectory import TrajectoryReplay
+
+# Every simulation lives in a session. /init returns its id and the other
+# endpoints take it as `session`, clients that don't send one share the
+# default session, like the Unity client.
+sessions = SessionRegistry()
 
+logger = logging.getLogger(__name__)
 
 
 number_agents = 10
 width = 24
 height = 25
-currentStep = 0
 
 app = Flask("Traffic example")
 
+def get_session():
+    return sessions.get(request.values.get('session', DEFAULT_SESSION))
+
+def no_session():
+    return jsonify({'message': 'Model not initiated, call /init first.'}), 404
+
+def no_car_budget():
+    return jsonify({'message': 'Server car limit reached, try again later.'}), 503
+
 @app.route('/init', methods=['GET', 'POST'])
 def initModel():
-    global citymodel
-
     number_agents = int(request.form.get('NAgents', 10))
     width = int(request.form.get('width', 20))
     height = int(request.form.get('height', 20))
-    currentStep = 0
-
-    print(request.form)
-    print(number_agents, width, height)
-     ##   if CityModel is None: return
-    citymodel = CityModel(number_agents)
 
-    return jsonify({"message":"Parameters recieved, model initiated."})
+    logger.info("Init with %s agents on %sx%s", number_agents, width, height)
+    # `new=1` always opens a new session instead of replacing one
+    session_id = None if request.values.get('new') == '1' else request.values.get('session', DEFAULT_SESSION)
+    # `replay`, `checkpoint`, `demand`, `warmup` and `profile`, see sessions.build_model
+    try:
+        citymodel = build_model(request.values)
+    except InitError as error:
+        return jsonify({'message': str(error)}), error.status
+    session = sessions.create(citymodel, session_id)
+
+    return jsonify({"message":"Parameters recieved, model initiated.", "session": session.id,
+                    "currentStep": citymodel.schedule.steps})
+
+@app.route('/save', methods=['GET', 'POST'])
+def saveCheckpoint():
+    # Saves the session's model as checkpoints/<name>.npz, for /init?checkpoint=<name>
+    session = get_session()
+    if session is None: return no_session()
+    if isinstance(session.model, TrajectoryReplay):
+        return jsonify({'message': 'Replays can\'t be saved.'}), 400
+    name = request.values.get('name', session.id)
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    with session.lock:
+        save_checkpoint(session.model, checkpoint_path(name))
+        currentStep = session.model.schedule.steps
+    return jsonify({'message': f'Checkpoint saved at step {currentStep}.', 'checkpoint': os.path.basename(checkpoint_path(name)),
+                    'currentStep': currentStep})
+
+@app.route('/close', methods=['GET', 'POST'])
+def closeSession():
+    closed = sessions.remove(request.values.get('session', DEFAULT_SESSION))
+    return jsonify({'message': 'Session closed.' if closed else 'No such session.'})
 
 
 
 @app.route('/getAgents', methods=['GET'])
 def getAgents():
-    if citymodel is None: return
-    agent_data = citymodel.get_agent_data()
+    session = get_session()
+    if session is None: return no_session()
+    with session.lock:
+        agent_data = session.model.get_agent_data()
 
-    print(agent_data)
     return jsonify({'positions': agent_data})
 
 @app.route('/getSemaphores', methods=['GET'])
 def getSemaphores():
-    if citymodel is None: return
-    agent_data = citymodel.get_semaphores()
+    session = get_session()
+    if session is None: return no_session()
+    with session.lock:
+        agent_data = session.model.get_semaphores()
 
-    print(agent_data)
     return jsonify({'positions': agent_data})
 
 @app.route('/getObstacles', methods=['GET'])
 def getObstacles():
-    global citymodel
-
-
     return jsonify({'positions': []})
 
 
 @app.route('/update', methods=['GET'])
 def updateModel():
-    global currentStep, CityModel
-    if request.method == 'GET':
-        citymodel.step()
-        currentStep += 1
-        return jsonify({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
+    session = get_session()
+    if session is None: return no_session()
+    if not sessions.has_car_budget(session.id): return no_car_budget()
+    with session.lock:
+        session.model.step()
+        currentStep = session.model.schedule.steps
+    return jsonify({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
+
+@app.route('/step', methods=['GET', 'POST'])
+def stepModel():
+    """
+    Advances the model and answers in a single round trip with what changed
+    since the client's last acknowledged step (`ack`). Without `ack`, with an
+    `ack` older than the change log or with `full=1` it sends every car and
+    light instead.
+    """
+    session = get_session()
+    if session is None: return no_session()
+    if not sessions.has_car_budget(session.id): return no_car_budget()
+    citymodel = session.model
+    steps = int(request.values.get('steps', 1))
+    with session.lock:
+        citymodel.enable_change_tracking()
+        for _ in range(steps):
+            citymodel.step()
+        currentStep = citymodel.schedule.steps
+
+        ack = request.values.get('ack')
+        changes = None
+        if request.values.get('full', '0') != '1' and ack is not None:
+            changes = citymodel.get_changes_since(int(ack))
+        if changes is None:
+            return jsonify({'currentStep': currentStep, 'full': True, 'cars': citymodel.get_agent_data(),
+                            'arrived': [], 'semaphores': citymodel.get_semaphores()})
+        return jsonify({'currentStep': currentStep, 'full': False, **changes})
+
+@app.route('/seek', methods=['GET', 'POST'])
+def seekReplay():
+    # Moves a replay session to `step`, clamped to the recorded steps
+    session = get_session()
+    if session is None: return no_session()
+    if not isinstance(session.model, TrajectoryReplay):
+        return jsonify({'message': 'Only replays can seek, start one with /init?replay=<name>.'}), 400
+    with session.lock:
+        session.model.seek(int(request.values.get('step', 0)))
+        currentStep = session.model.schedule.steps
+    return jsonify({'message': f'Replay at step {currentStep}.', 'currentStep': currentStep,
+                    'firstStep': session.model.first_step, 'lastStep': session.model.last_step})
+
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    """
+    Time spent per phase of the step and counters of the session's model,
+    only collected for sessions started with /init?profile=1.
+    """
+    session = get_session()
+    if session is None: return no_session()
+    with session.lock:
+        citymodel = session.model
+        profile = citymodel.profiler.snapshot() if citymodel.profiler is not None else None
+        return jsonify({'currentStep': citymodel.schedule.steps, 'activeCars': citymodel.active_agents,
+                        'arrivedCars': citymodel.arrived_agents, 'profiling': profile is not None,
+                        'profile': profile})
+
+@app.route('/stream/start', methods=['GET', 'POST'])
+def startStream():
+    """
+    Runs the model on a background thread at `rate` ticks per second.
+    Frames are read from /stream, slow readers skip to the newest frame once
+    `buffer` frames are waiting.
+    """
+    session = get_session()
+    if session is None: return no_session()
+    if session.stream is None:
+        session.stream = FrameStream(session.model, session.lock,
+                                     tick_rate=float(request.values.get('rate', 10)),
+                                     buffer_size=int(request.values.get('buffer', 32)))
+    session.stream.start()
+    return jsonify({'message': f'Streaming at {session.stream.tick_rate} ticks per second.'})
+
+@app.route('/stream/stop', methods=['GET', 'POST'])
+def stopStream():
+    session = get_session()
+    if session is not None:
+        session.stop_stream()
+    return jsonify({'message': 'Stream stopped.'})
+
+@app.route('/stream', methods=['GET'])
+def streamFrames():
+    # Server-sent events, one `data:` line of JSON per tick
+    session = get_session()
+    if session is None: return no_session()
+    if session.stream is None:
+        return jsonify({'message': 'Stream not started, call /stream/start first.'}), 400
+    subscriber = session.stream.subscribe()
+    return Response(session.stream.events(subscriber), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 
 if __name__=='__main__':
-    app.run(host="localhost", port=8585, debug=True)
+    # LOG_LEVEL=DEBUG also logs every car's path finding
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    app.run(host="localhost", port=8585, debug=True, threaded=True)
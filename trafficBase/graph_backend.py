@@ -0,0 +1,203 @@
+#graph_backend.py
+# Routing backends of CityModel, picked with CityModel(graph_backend=...).
+# Both answer the same queries on the road graph: A* between two cells and
+# the reverse shortest path tree of a destination, with nodes numbered in the
+# order the model adds them.
+import heapq
+import math
+
+import networkx as nx
+import numpy as np
+
+from agent import heuristic
+from profiling import count
+
+
+class NetworkXBackend:
+    """
+    Routing on the model's networkx graph.
+    """
+    name = "networkx"
+
+    def __init__(self, G, profiler=None):
+        self.G = G
+        self.profiler = profiler
+        self.nodes = list(G.nodes)
+        self.ids = {node: i for i, node in enumerate(self.nodes)}
+
+    def weight(self, u, v):
+        return self.G.edges[u, v]['weight']
+
+    def set_weight(self, u, v, weight):
+        self.G.edges[u, v]['weight'] = weight
+
+    def astar_path(self, start, destination, extra=None):
+        weight = 'weight'
+        if extra:
+            weight = lambda u, v, data: data['weight'] + extra.get((u, v), 0)
+        count(self.profiler, "astar_calls")
+        return nx.astar_path(self.G, start, destination, heuristic, weight=weight)
+
+    def reverse_tree(self, destination):
+        """
+        (next_hop, distance) lists indexed by node id, next_hop is -1 for the
+        destination and for nodes that cannot reach it.
+        """
+        # Predecessors on the reversed graph are the next hops on the real one
+        pred, dist = nx.dijkstra_predecessor_and_distance(self.G.reverse(copy=False), destination)
+        next_hop = [-1] * len(self.nodes)
+        distance = [math.inf] * len(self.nodes)
+        for node, hops in pred.items():
+            if hops:
+                next_hop[self.ids[node]] = self.ids[hops[0]]
+        for node, cost in dist.items():
+            distance[self.ids[node]] = cost
+        return next_hop, distance
+
+
+class CSRBackend:
+    """
+    Road graph as CSR arrays with integer node ids, taken from the compiled
+    map: the edges of node i are indices[indptr[i]:indptr[i + 1]] and cost
+    weights[...]. A reverse copy (rindptr, rindices, redges) points back to
+    the forward edges for Dijkstra towards a destination.
+    The search loops read list copies of the arrays, indexing NumPy arrays
+    element by element from Python is several times slower.
+    """
+    name = "csr"
+
+    def __init__(self, compiled_map, G, profiler=None, weights=None):
+        self.G = G  # Kept in sync by set_weight, for drawing and Car fallbacks
+        self.profiler = profiler
+        self.nodes = [tuple(node) for node in compiled_map.nodes.tolist()]
+        self.ids = {node: i for i, node in enumerate(self.nodes)}
+        self.indptr = np.asarray(compiled_map.indptr, dtype=np.int64)
+        self.indices = np.asarray(compiled_map.indices, dtype=np.int64)
+        sources = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        if weights is None:
+            # Without a graph (G=None) the caller passes the weights in CSR order
+            weights = [G.edges[self.nodes[u], self.nodes[v]]['weight']
+                       for u, v in zip(sources.tolist(), self.indices.tolist())]
+        self.weights = np.array(weights, dtype=np.float64)
+
+        # Incoming edges of each node in the order they were added, like G.pred
+        order = np.lexsort((np.asarray(compiled_map.edge_rank), self.indices))
+        self.rindptr = np.concatenate([[0], np.cumsum(np.bincount(self.indices, minlength=len(self.nodes)))])
+        self.rindices = sources[order]
+        self.redges = order
+
+        self.indptr_list = self.indptr.tolist()
+        self.indices_list = self.indices.tolist()
+        self.weights_list = self.weights.tolist()
+        self.rindptr_list = self.rindptr.tolist()
+        self.rindices_list = self.rindices.tolist()
+        self.redges_list = self.redges.tolist()
+        self.xs = [node[0] for node in self.nodes]
+        self.ys = [node[1] for node in self.nodes]
+
+    def edge_position(self, u, v):
+        u, v = self.ids[u], self.ids[v]
+        for position in range(self.indptr_list[u], self.indptr_list[u + 1]):
+            if self.indices_list[position] == v:
+                return position
+        raise KeyError((self.nodes[u], self.nodes[v]))
+
+    def weight(self, u, v):
+        return self.weights_list[self.edge_position(u, v)]
+
+    def set_weight(self, u, v, weight):
+        position = self.edge_position(u, v)
+        self.weights[position] = weight
+        self.weights_list[position] = weight
+        if self.G is not None:
+            self.G.edges[u, v]['weight'] = weight
+
+    def astar_path(self, start, destination, extra=None):
+        """
+        Same result as nx.astar_path with the Euclidean heuristic; extra maps
+        (u, v) cells to a cost added to that edge.
+        """
+        if start not in self.ids or destination not in self.ids:
+            raise nx.NodeNotFound(f"Either source {start} or target {destination} is not in G")
+        count(self.profiler, "astar_calls")
+        source, target = self.ids[start], self.ids[destination]
+        indptr, indices, weights, nodes = self.indptr_list, self.indices_list, self.weights_list, self.nodes
+        xs, ys = self.xs, self.ys
+        tx, ty = xs[target], ys[target]
+
+        # (f, counter, node, g, parent), the counter keeps ties in push order
+        queue = [(math.sqrt((xs[source] - tx)**2 + (ys[source] - ty)**2), 0, source, 0, -1)]
+        counter = 1
+        enqueued = {}  # node -> (g, h)
+        explored = {}  # node -> parent
+        while queue:
+            _, _, node, g, parent = heapq.heappop(queue)
+            if node == target:
+                count(self.profiler, "astar_nodes_expanded", len(explored) + 1)
+                path = [nodes[node]]
+                while parent != -1:
+                    path.append(nodes[parent])
+                    parent = explored[parent]
+                path.reverse()
+                return path
+            if node in explored:
+                # A node can be queued several times, only its best entry counts
+                if explored[node] == -1:
+                    continue
+                queued_g, _ = enqueued[node]
+                if queued_g < g:
+                    continue
+            explored[node] = parent
+            for position in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[position]
+                cost = g + weights[position]
+                if extra:
+                    cost += extra.get((nodes[node], nodes[neighbor]), 0)
+                if neighbor in enqueued:
+                    queued_g, h = enqueued[neighbor]
+                    if queued_g <= cost:
+                        continue
+                else:
+                    h = math.sqrt((xs[neighbor] - tx)**2 + (ys[neighbor] - ty)**2)
+                enqueued[neighbor] = (cost, h)
+                heapq.heappush(queue, (cost + h, counter, neighbor, cost, node))
+                counter += 1
+        count(self.profiler, "astar_nodes_expanded", len(explored))
+        raise nx.NetworkXNoPath(f"Node {destination} not reachable from {start}")
+
+    def reverse_tree(self, destination):
+        """
+        (next_hop, distance) lists indexed by node id, next_hop is -1 for the
+        destination and for nodes that cannot reach it.
+        """
+        target = self.ids[destination]
+        rindptr, rindices, redges, weights = self.rindptr_list, self.rindices_list, self.redges_list, self.weights_list
+        next_hop = [-1] * len(self.nodes)
+        distance = [math.inf] * len(self.nodes)
+        distance[target] = 0
+        done = [False] * len(self.nodes)
+        queue = [(0, 0, target)]
+        counter = 1
+        while queue:
+            cost, _, node = heapq.heappop(queue)
+            if done[node]:
+                continue
+            done[node] = True
+            for position in range(rindptr[node], rindptr[node + 1]):
+                previous = rindices[position]
+                new_cost = cost + weights[redges[position]]
+                if new_cost < distance[previous]:
+                    distance[previous] = new_cost
+                    next_hop[previous] = node
+                    heapq.heappush(queue, (new_cost, counter, previous))
+                    counter += 1
+        return next_hop, distance
+
+
+def make_backend(name, compiled_map, G, profiler=None, weights=None):
+    # weights, in CSR order, spare the csr backend reading them back from G
+    if name == "csr":
+        return CSRBackend(compiled_map, G, profiler, weights)
+    if name == "networkx":
+        return NetworkXBackend(G, profiler)
+    raise ValueError(f"Unknown graph backend {name!r}, use 'csr' or 'networkx'")
@@ -0,0 +1,72 @@
+#light_scheduler.py
+# Traffic light timing for CityModel. Lights are not in the agent schedule,
+# a heap of due steps tells the model which ones toggle on a given step.
+# A light with period T and offset o toggles on the steps where
+# (step - o) % T == 0; offset 0 everywhere is the map's plain timing.
+#
+# Phase plans come from the "plans" entry of mapDictionary.json, e.g.
+#   "plans": {"green_wave": {">": 1, "<": 1}}
+# delays the lights of the ">" and "<" corridors by 1 step per cell along
+# their direction of travel, so a car driving at one cell per step meets
+# them at the same point of their cycle. CityModel(light_plan="green_wave").
+import heapq
+
+from map_compiler import direction_names
+
+
+class LightScheduler:
+    def __init__(self, lights, periods, offsets, step=0):
+        self.lights = lights
+        self.periods = periods
+        self.offsets = offsets
+        self.reset(step)
+
+    def next_due(self, index, step):
+        # First step at or after `step` on which the light toggles
+        return step + (self.offsets[index] - step) % self.periods[index]
+
+    def reset(self, step):
+        self.heap = [(self.next_due(i, step), i) for i in range(len(self.lights))]
+        heapq.heapify(self.heap)
+
+    def due(self, step):
+        """
+        Lights that toggle on `step`, in map order. Steps must be asked for
+        in order, without gaps.
+        """
+        fired = []
+        while self.heap and self.heap[0][0] <= step:
+            _, index = heapq.heappop(self.heap)
+            fired.append(index)
+            heapq.heappush(self.heap, (step + self.periods[index], index))
+        fired.sort()
+        return [self.lights[index] for index in fired]
+
+
+def corridor_direction(model, light):
+    # Direction of the one-way roads that lead into the light
+    for u, _ in model.light_edges.get(light.pos, []):
+        directions = direction_names(model.road_directions[u])
+        if len(directions) == 1:
+            return directions[0]
+    return None
+
+
+def plan_offsets(model, plan_name):
+    """
+    Offset of every light under the named plan of the map dictionary.
+    """
+    if plan_name is None:
+        return [0] * len(model.traffic_lights)
+    plans = model.dataDictionary.get("plans", {})
+    if plan_name not in plans:
+        raise ValueError(f"Unknown light plan {plan_name!r}, the map dictionary has {sorted(plans)}")
+    # Steps of delay per cell, by the direction of the corridor
+    delays = {model.dataDictionary[symbol]: delay for symbol, delay in plans[plan_name].items()}
+    offsets = []
+    for light in model.traffic_lights:
+        x, y = light.pos
+        direction = corridor_direction(model, light)
+        travelled = {"Right": x, "Left": model.width - 1 - x, "Up": y, "Down": model.height - 1 - y}.get(direction, 0)
+        offsets.append(round(delays.get(direction, 0) * travelled))
+    return offsets
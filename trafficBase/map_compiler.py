@@ -0,0 +1,223 @@
+#map_compiler.py
+# Turns a city_files/*.txt map and its dictionary into a cached binary
+# artifact: the cell lookups CityModel uses and the road graph as CSR arrays.
+# Artifacts are directories of .npy files keyed by a hash of the map and the
+# dictionary, loaded memory-mapped so parallel workers share the pages.
+#
+#   python map_compiler.py city_files/2023_base.txt
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+FORMAT_VERSION = 1
+CACHE_DIR = os.path.join('city_files', '.cache')
+
+# Values of cell_types
+EMPTY, ROAD, TRAFFIC_LIGHT, OBSTACLE, DESTINATION = range(5)
+# Bits of road_directions, in the order the map dictionary lists them
+DIRECTION_BITS = {'Up': 1, 'Down': 2, 'Left': 4, 'Right': 8}
+ROAD_SYMBOLS = ["v", "^", ">", "<", "u", "g", "h", "k"]
+LIGHT_SYMBOLS = ["S", "s"]
+
+DIRECTIONS = {'Up': (0, 1), 'Down': (0, -1), 'Left': (-1, 0), 'Right': (1, 0)}
+DIAGONAL_DIRECTIONS = {
+    'Up': [('Up', 'Right'), ('Up', 'Left')],
+    'Down': [('Down', 'Right'), ('Down', 'Left')],
+    'Left': [('Left', 'Up'), ('Left', 'Down')],
+    'Right': [('Right', 'Up'), ('Right', 'Down')]
+}
+DIAGONAL_FACTOR = 3  # Diagonal edges cost three straight steps
+
+
+class CompiledMap:
+    """
+    Arrays of a compiled map, indexed [x, y] like the grid except `symbols`,
+    which keeps the rows of the text file. Graph nodes are numbered in the
+    order CityModel adds them and `nodes[i]` is the (x, y) cell of node i.
+    The edges of node i are indices[indptr[i]:indptr[i + 1]] with weight
+    factors in `factors`; `edge_rank` is the order in which the model adds
+    them to its graph.
+    """
+    ARRAYS = ["symbols", "cell_types", "road_directions", "light_index", "passable", "light_times",
+              "light_initial", "light_cells", "destinations", "nodes", "indptr", "indices", "factors", "edge_rank"]
+
+    def __init__(self, arrays, key, path=None):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.width, self.height = self.cell_types.shape
+        self.key = key
+        self.path = path
+
+    def edges(self):
+        """
+        ((x, y), (x, y), factor) in the order they were found.
+        """
+        sources = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        nodes = [tuple(node) for node in self.nodes.tolist()]
+        for position in np.argsort(self.edge_rank, kind='stable').tolist():
+            yield nodes[sources[position]], nodes[self.indices[position]], int(self.factors[position])
+
+
+def map_key(map_text, dictionary):
+    content = json.dumps([FORMAT_VERSION, map_text, dictionary], sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+
+def direction_names(bits):
+    return [direction for direction, bit in DIRECTION_BITS.items() if bits & bit]
+
+
+def parse_cells(lines, dictionary):
+    rows = [line.strip() for line in lines]
+    width, height = len(rows[0]), len(rows)
+    symbols = np.full((height, width), ord(' '), dtype=np.uint8)
+    cell_types = np.full((width, height), EMPTY, dtype=np.int8)
+    road_directions = np.zeros((width, height), dtype=np.uint8)
+    light_index = np.full((width, height), -1, dtype=np.int32)
+    light_times = np.zeros((width, height), dtype=np.int32)
+    light_cells, light_initial, destinations, nodes = [], [], [], []
+
+    for r, row in enumerate(rows):
+        for c, col in enumerate(row):
+            x, y = c, height - r - 1
+            symbols[r, c] = ord(col)
+            if col in ROAD_SYMBOLS:
+                cell_types[x, y] = ROAD
+                directions = dictionary[col] if isinstance(dictionary[col], list) else [dictionary[col]]
+                for direction in directions:
+                    road_directions[x, y] |= DIRECTION_BITS[direction]
+                nodes.append((x, y))
+            elif col in LIGHT_SYMBOLS:
+                cell_types[x, y] = TRAFFIC_LIGHT
+                light_index[x, y] = len(light_cells)
+                light_times[x, y] = int(dictionary[col])
+                light_cells.append((x, y))
+                light_initial.append(col == "s")  # "S" starts red, "s" green
+                nodes.append((x, y))
+            elif col == "#":
+                cell_types[x, y] = OBSTACLE
+            elif col == "D":
+                cell_types[x, y] = DESTINATION
+                destinations.append((x, y))
+                nodes.append((x, y))
+
+    passable = np.isin(cell_types, [ROAD, TRAFFIC_LIGHT, DESTINATION])
+    return {
+        "symbols": symbols,
+        "cell_types": cell_types,
+        "road_directions": road_directions,
+        "light_index": light_index,
+        "passable": passable,
+        "light_times": light_times,
+        "light_initial": np.array(light_initial, dtype=bool),
+        "light_cells": np.array(light_cells, dtype=np.int32).reshape(-1, 2),
+        "destinations": np.array(destinations, dtype=np.int32).reshape(-1, 2),
+        "nodes": np.array(nodes, dtype=np.int32).reshape(-1, 2),
+    }
+
+
+def find_edges(cell_types, road_directions, passable):
+    """
+    Road graph edges as {(u, v): factor}, in the order CityModel used to add
+    them. Roads connect along their direction plus the two diagonals ahead,
+    never straight into a light; lights connect to the roads around them
+    and roads next to a destination lead into it.
+    """
+    width, height = cell_types.shape
+    edges = {}
+
+    def valid(x, y):
+        return 0 <= x < width and 0 <= y < height and passable[x, y]
+
+    def aligns_with_road_direction(tl_x, tl_y, road_x, road_y):
+        # Only single direction roads lead into a light
+        direction = road_directions[road_x, road_y]
+        return ((direction == DIRECTION_BITS["Up"] and road_y < tl_y)
+                or (direction == DIRECTION_BITS["Down"] and road_y > tl_y)
+                or (direction == DIRECTION_BITS["Left"] and road_x > tl_x)
+                or (direction == DIRECTION_BITS["Right"] and road_x < tl_x))
+
+    for x in range(width):
+        for y in range(height):
+            cell_type = cell_types[x, y]
+            if cell_type == DESTINATION:
+                for dx, dy in DIRECTIONS.values():
+                    nx, ny = x + dx, y + dy
+                    if valid(nx, ny) and cell_types[nx, ny] == ROAD:
+                        edges[(nx, ny), (x, y)] = 1
+            elif cell_type == ROAD:
+                for direction in direction_names(road_directions[x, y]):
+                    dx, dy = DIRECTIONS[direction]
+                    nx, ny = x + dx, y + dy
+                    if valid(nx, ny) and cell_types[nx, ny] != TRAFFIC_LIGHT:
+                        edges[(x, y), (nx, ny)] = 1
+                        for first, second in DIAGONAL_DIRECTIONS[direction]:
+                            nnx = x + DIRECTIONS[first][0] + DIRECTIONS[second][0]
+                            nny = y + DIRECTIONS[first][1] + DIRECTIONS[second][1]
+                            if valid(nnx, nny) and cell_types[nnx, nny] != TRAFFIC_LIGHT:
+                                edges[(x, y), (nnx, nny)] = DIAGONAL_FACTOR
+            elif cell_type == TRAFFIC_LIGHT:
+                for dx, dy in DIRECTIONS.values():
+                    adjacent_x, adjacent_y = x + dx, y + dy
+                    if valid(adjacent_x, adjacent_y) and cell_types[adjacent_x, adjacent_y] == ROAD:
+                        if aligns_with_road_direction(x, y, adjacent_x, adjacent_y):
+                            edges[(adjacent_x, adjacent_y), (x, y)] = 1
+                        else:
+                            edges[(x, y), (adjacent_x, adjacent_y)] = 1
+    return edges
+
+
+def compile_map(lines, dictionary):
+    arrays = parse_cells(lines, dictionary)
+    edges = find_edges(arrays["cell_types"], arrays["road_directions"], arrays["passable"])
+
+    node_ids = {tuple(node): i for i, node in enumerate(arrays["nodes"].tolist())}
+    sources = np.array([node_ids[u] for u, v in edges], dtype=np.int32)
+    targets = np.array([node_ids[v] for u, v in edges], dtype=np.int32)
+    factors = np.array(list(edges.values()), dtype=np.int8)
+    order = np.argsort(sources, kind='stable')
+    arrays["indptr"] = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=len(node_ids)))]).astype(np.int32)
+    arrays["indices"] = targets[order]
+    arrays["factors"] = factors[order]
+    arrays["edge_rank"] = order.astype(np.int32)
+    return arrays
+
+
+def load_map(map_file, dictionary, cache_dir=CACHE_DIR):
+    """
+    Compiled map for a map file, built and cached on first use.
+    """
+    with open(map_file) as baseFile:
+        lines = baseFile.readlines()
+    key = map_key("".join(lines), dictionary)
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        write_artifact(compile_map(lines, dictionary), path)
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in CompiledMap.ARRAYS}
+    return CompiledMap(arrays, key, path)
+
+
+def write_artifact(arrays, path):
+    # Written next to its final place and renamed, so readers never see half an artifact
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    staging = tempfile.mkdtemp(dir=os.path.dirname(path))
+    for name in CompiledMap.ARRAYS:
+        np.save(os.path.join(staging, name + '.npy'), arrays[name])
+    try:
+        os.rename(staging, path)
+    except OSError:
+        # Another process compiled the same map first
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    dictionary = json.load(open(os.path.join('city_files', 'mapDictionary.json')))
+    for map_file in sys.argv[1:]:
+        compiled = load_map(map_file, dictionary)
+        print(f"{map_file}: {compiled.width}x{compiled.height}, {len(compiled.nodes)} nodes, "
+              f"{len(compiled.indices)} edges -> {compiled.path}")
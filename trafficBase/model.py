@@ -1,175 +1,348 @@
 #model.py
 import networkx as nx
+import numpy as np
 import json
-import random
-import requests
+import logging
+from collections import deque
 import matplotlib.pyplot as plt
 from mesa import Model
 from mesa.time import RandomActivation
 from mesa.space import MultiGrid
-from agent import Car, Road, Traffic_Light, Obstacle, Destination  # Assuming these are defined in 'agent.py'
+from agent import Car, CostOverlay, Road, Traffic_Light, Obstacle, Destination, StaticCell  # Assuming these are defined in 'agent.py'
+from routes import make_routes
+from graph_backend import make_backend
+from array_engine import ArrayCarEngine
+from partitioned_engine import PartitionedCarEngine
+from metrics import default_sink
+from congestion import CongestionField
+from demand import DemandProfile
+from light_scheduler import LightScheduler, plan_offsets
+from profiling import StepProfiler, count, phase
+from map_compiler import (ROAD, TRAFFIC_LIGHT, OBSTACLE, DESTINATION, ROAD_SYMBOLS,
+                          direction_names, load_map)
+
+logger = logging.getLogger(__name__)
 
 class CityModel(Model):
-    def __init__(self, N):
-        map_file = 'city_files/2023_base.txt'
+    def __init__(self, N, engine="mesa", map_file='city_files/2023_base.txt', spawn_every=3, light_times=None,
+                 max_steps=1000, report=True, metrics=None, static_agents=True,
+                 graph_backend="csr", profile=False, workers=None, congestion_every=None, congestion_weight=2.0,
+                 light_plan=None, demand=None, routing="trees", seed=None):
+        # What the model was built with, saved in checkpoints
+        self.params = {"N": N, "engine": engine, "map_file": map_file, "spawn_every": spawn_every,
+                       "light_times": light_times, "max_steps": max_steps, "static_agents": static_agents,
+                       "graph_backend": graph_backend, "workers": workers, "congestion_every": congestion_every,
+                       "congestion_weight": congestion_weight, "light_plan": light_plan, "demand": demand,
+                       "routing": routing, "seed": seed}
         map_dict_file = 'city_files/mapDictionary.json'
         self.dataDictionary = json.load(open(map_dict_file))
+        # Overrides for the light timings of the dictionary, e.g. {"S": 15, "s": 7}
+        if light_times:
+            self.dataDictionary.update(light_times)
+        self.spawn_every = spawn_every
+        self.max_steps = max_steps
+        # Every 100 steps the arrived cars go to a metrics sink, the class server by default,
+        # close() writes what is still queued
+        self.metrics = (metrics or default_sink()) if report else None
+        # Per phase timers and counters, see profiling.py
+        self.profiler = StepProfiler() if profile else None
         self.traffic_lights = []
         self.destinations = []
-        self.G = nx.DiGraph()  # Graph representing the city
+        self.graph = None  # Graph backend the routes run on
+        self.nx_graph = None  # networkx copy of the road graph, see G
+        # Without static agents roads, obstacles and destinations only live in the cell arrays
+        self.static_agents = static_agents
+        self.light_edges = {}  # Light cell -> edges that point into it
+        self.pending_lights = set()  # Lights that toggled during the current step
+        self.edge_penalty = None  # Congestion cost per cell, added to the edges into it
+        self.route_epoch = 0  # Bumped when the congestion costs change, cars then re-route
         self.car_id_counter = 0
 
-        with open(map_file) as baseFile:
-            lines = baseFile.readlines()
-            self.width = len(lines[0].strip())
-            self.height = len(lines)
-
-            self.grid = MultiGrid(self.width, self.height, torus=False)
-            self.schedule = RandomActivation(self)
-
-            for r, row in enumerate(lines):
-                for c, col in enumerate(row.strip()):
+        # Cell lookups and road graph come from the compiled map, cached on disk
+        self.compiled_map = load_map(map_file, self.dataDictionary)
+        self.width = self.compiled_map.width
+        self.height = self.compiled_map.height
+
+        # Every `congestion_every` steps the routes take the cars on the road into account
+        if congestion_every and engine == "partitioned":
+            raise ValueError("Congestion routing is not available on the partitioned engine")
+        self.congestion = CongestionField(self.width, self.height, congestion_every, congestion_weight) \
+            if congestion_every else None
+
+        self.grid = MultiGrid(self.width, self.height, torus=False)
+        self.schedule = RandomActivation(self)
+
+        # Static lookups indexed [x, y] like the grid, read-only
+        self.cell_types = self.compiled_map.cell_types
+        self.road_directions = self.compiled_map.road_directions
+        self.light_index = self.compiled_map.light_index
+        self.passable = self.compiled_map.passable
+        # Cars per cell, kept by place_car/move_car/remove_car so blocking
+        # checks don't go through the grid. Counts, cars share their spawn corner.
+        self.occupancy = np.zeros((self.width, self.height), dtype=np.uint16)
+
+        # Lights and destinations come from the compiled map, the other cells
+        # only get agents with static agents
+        self.add_traffic_lights()
+        self.destinations = [tuple(cell) for cell in np.asarray(self.compiled_map.destinations).tolist()]
+        if self.static_agents:
+            for r, row in enumerate(self.compiled_map.symbols):
+                for c, col in enumerate(row.tobytes().decode()):
                     self.process_cell(r, c, col)
 
+        # Cells place_single_car spawns on, fixed for the map
+        self.spawn_corners = [corner for corner in [(0, 0), (self.width - 1, 0), (0, self.height - 1),
+                                                    (self.width - 1, self.height - 1)]
+                              if self.is_suitable_for_car(corner)]
 
         self.num_agents = N
         self.running = True
         # Add code to place edges
-        self.add_edges()
+        edge_weights = self.add_edges()
+        # Lights are not scheduled agents, the scheduler says which toggle on each step
+        self.light_scheduler = LightScheduler(self.traffic_lights, [light.timeToChange for light in self.traffic_lights],
+                                              plan_offsets(self, light_plan))
+        # Routing runs on the backend ("csr" arrays or "networkx"), only the networkx one builds self.G
+        self.graph = make_backend(graph_backend, self.compiled_map, self.G if graph_backend == "networkx" else None,
+                                  self.profiler, edge_weights)
+        # "trees" builds every destination tree on the whole graph, "zones" on
+        # the graph between the lights, for large tiled maps (routes.py)
+        self.routes = make_routes(routing, self.graph, self.destinations,
+                                  [light.pos for light in self.traffic_lights], self.profiler)
+        # "array" keeps the cars in NumPy arrays instead of the schedule, for headless runs,
+        # "partitioned" splits them over `workers` processes for large maps
+        if engine == "array":
+            self.engine = ArrayCarEngine(self)
+        elif engine == "partitioned":
+            self.engine = PartitionedCarEngine(self, workers)
+        else:
+            self.engine = None
+        # With a demand file the cars come in batches from its OD matrices, see demand.py
+        self.demand = DemandProfile.load(demand, self, np.random.default_rng(self.random.getrandbits(64))) \
+            if demand else None
         self.num_cars = 0
         self.active_agents = 0
         self.arrived_agents = 0
+        self.change_log = None  # Per step changes for delta updates, see enable_change_tracking
+
+    def add_traffic_lights(self):
+        # In the compiler's order, which light_index numbers them by
+        compiled_map = self.compiled_map
+        initial = np.asarray(compiled_map.light_initial).tolist()
+        for i, (x, y) in enumerate(np.asarray(compiled_map.light_cells).tolist()):
+            r = self.height - y - 1
+            agent = Traffic_Light(f"tl_{r*self.width+x}", self, initial[i], int(compiled_map.light_times[x, y]))
+            self.grid.place_agent(agent, (x, y))
+            self.traffic_lights.append(agent)
 
     def process_cell(self, r, c, col):
-        if col in ["v", "^", ">", "<", "u", "g", "h", "k"]:
+        # Agents of the static cells, lights are added by add_traffic_lights
+        x, y = c, self.height - r - 1
+        if col in ROAD_SYMBOLS:
             agent = Road(f"r_{r*self.width+c}", self, self.dataDictionary[col])
-            self.grid.place_agent(agent, (c, self.height - r - 1))
-            self.G.add_node((c, self.height - r - 1), type='road')
-
-        elif col in ["S", "s"]:
-            agent = Traffic_Light(f"tl_{r*self.width+c}", self, False if col == "S" else True, int(self.dataDictionary[col]))
-            self.grid.place_agent(agent, (c, self.height - r - 1))
-            self.schedule.add(agent)
-            self.traffic_lights.append(agent)
-            self.G.add_node((c, self.height - r - 1), type='traffic_light')
+            self.grid.place_agent(agent, (x, y))
 
         elif col == "#":
             agent = Obstacle(f"ob_{r*self.width+c}", self)
-            self.grid.place_agent(agent, (c, self.height - r - 1))
+            self.grid.place_agent(agent, (x, y))
 
         elif col == "D":
             agent = Destination(f"d_{r*self.width+c}", self)
-            self.grid.place_agent(agent, (c, self.height - r - 1))
-            self.destinations.append((c, self.height - r - 1))
-            self.G.add_node((c, self.height - r - 1), type='destination')
+            self.grid.place_agent(agent, (x, y))
+
+    @property
+    def G(self):
+        """
+        The road graph as a networkx DiGraph, built on first use: the csr
+        backend routes on the compiled arrays, drawing and the networkx
+        backend need the graph. The csr backend keeps its weights in sync.
+        """
+        if self.nx_graph is None:
+            self.nx_graph = self.build_graph()
+            if self.graph is not None and self.graph.name == "csr":
+                self.graph.G = self.nx_graph
+        return self.nx_graph
+
+    def build_graph(self):
+        # Nodes and edges in the order the compiler numbered and found them, at the current weights
+        compiled_map = self.compiled_map
+        nodes = [tuple(node) for node in np.asarray(compiled_map.nodes).tolist()]
+        node_types = {ROAD: 'road', TRAFFIC_LIGHT: 'traffic_light', DESTINATION: 'destination'}
+        G = nx.DiGraph()
+        G.add_nodes_from((node, {'type': node_types[int(self.cell_types[node])]}) for node in nodes)
+        sources = np.repeat(np.arange(len(nodes)), np.diff(np.asarray(compiled_map.indptr)))
+        order = np.argsort(compiled_map.edge_rank, kind='stable')
+        weights = self.graph.weights if self.graph is not None and self.graph.name == "csr" else self.edge_weights()
+        G.add_weighted_edges_from(zip([nodes[u] for u in sources[order].tolist()],
+                                      [nodes[v] for v in np.asarray(compiled_map.indices)[order].tolist()],
+                                      np.asarray(weights)[order].tolist()))
+        return G
 
     def place_single_car(self):
-        corners = [(0, 0), (self.width - 1, 0), (0, self.height - 1), (self.width - 1, self.height - 1)]
-        suitable_corners = [corner for corner in corners if self.is_suitable_for_car(corner)]
+        suitable_corners = self.spawn_corners
 
         if suitable_corners and self.destinations:
-            start_pos = random.choice(suitable_corners)
-            destination = random.choice(self.destinations)
-            car_graph = self.generate_graph_for_car("car_" + str(self.car_id_counter))
-            car = Car("car_" + str(self.car_id_counter), self, start_pos, destination, car_graph)
-            self.grid.place_agent(car, start_pos)
-            self.schedule.add(car)
+            start_pos = self.random.choice(suitable_corners)
+            destination = self.random.choice(self.destinations)
+            if self.engine is not None:
+                self.engine.add_car(self.car_id_counter, start_pos, destination)
+                self.num_cars += 1
+                self.active_agents += 1
+                self.car_id_counter += 1
+                return
+            car_overlay = self.generate_overlay_for_car("car_" + str(self.car_id_counter))
+            car = Car("car_" + str(self.car_id_counter), self, start_pos, destination, car_overlay)
+            self.place_car(car, start_pos)
             self.num_cars += 1
             self.active_agents += 1
             self.car_id_counter += 1  # Increment the counter after adding a car
 
+    def add_cars(self, starts, destinations):
+        """
+        Spawns a batch of cars. Their first paths are planned together, one
+        lookup per start and destination pair.
+        """
+        n = len(starts)
+        if n == 0:
+            return
+        numbers = list(range(self.car_id_counter, self.car_id_counter + n))
+        if self.engine is not None:
+            self.engine.add_cars(numbers, starts, destinations)
+        else:
+            starts_by_destination = {}
+            for start, destination in zip(starts, destinations):
+                starts_by_destination.setdefault(destination, set()).add(start)
+            paths = {}
+            nodes = self.graph.nodes
+            for destination, pair_starts in starts_by_destination.items():
+                pair_starts = list(pair_starts)
+                with phase(self.profiler, "pathfinding"):
+                    found = self.routes.node_paths(pair_starts, destination)
+                for start, path in zip(pair_starts, found):
+                    if path is not None:
+                        paths[start, destination] = [nodes[node] for node in path.tolist()]
+            for number, start, destination in zip(numbers, starts, destinations):
+                car_id = "car_" + str(number)
+                car = Car(car_id, self, start, destination, self.generate_overlay_for_car(car_id))
+                car.path = list(paths.get((start, destination), []))
+                self.place_car(car, start)
+        self.car_id_counter += n
+        self.num_cars += n
+        self.active_agents += n
+
+    def place_car(self, car, pos):
+        self.grid.place_agent(car, pos)
+        self.schedule.add(car)
+        self.occupancy[pos] += 1
+
+    def move_car(self, car, pos):
+        self.occupancy[car.pos] -= 1
+        self.grid.move_agent(car, pos)
+        self.occupancy[pos] += 1
+
+    def remove_car(self, car):
+        self.occupancy[car.pos] -= 1
+        self.schedule.remove(car)
+        self.grid.remove_agent(car)
+
+    def is_occupied(self, x, y):
+        return self.occupancy[x, y] > 0
+
+    def is_red_light(self, x, y):
+        light = self.light_index[x, y]
+        return light >= 0 and not self.traffic_lights[light].state
+
     def is_suitable_for_car(self, cell):
-        cell_contents = self.grid.get_cell_list_contents(cell)
-        return any(isinstance(agent, Road) for agent in cell_contents) and not any(isinstance(agent, (Obstacle, Traffic_Light, Destination)) for agent in cell_contents)
+        return self.cell_types[cell] == ROAD
 
     def is_road(self, x, y):
-        contents = self.grid.get_cell_list_contents((x, y))
-        return any(isinstance(content, Road) for content in contents)
+        return self.cell_types[x, y] == ROAD
 
     def is_destination(self, x, y):
-        contents = self.grid.get_cell_list_contents((x, y))
-        return any(isinstance(content, Destination) for content in contents)
+        return self.cell_types[x, y] == DESTINATION
+
+    def static_cell(self, x, y):
+        """
+        The road, obstacle or destination at (x, y) as a StaticCell, None for
+        other cells. Only models built with static_agents=False use these.
+        """
+        cell_type = self.cell_types[x, y]
+        if cell_type == ROAD:
+            directions = direction_names(self.road_directions[x, y])
+            return StaticCell("road", (x, y), directions[0] if len(directions) == 1 else directions)
+        if cell_type == OBSTACLE:
+            return StaticCell("obstacle", (x, y))
+        if cell_type == DESTINATION:
+            return StaticCell("destination", (x, y))
+        return None
 
     def add_edges(self):
-        directions = {'Up': (0, 1), 'Down': (0, -1), 'Left': (-1, 0), 'Right': (1, 0)}
-        diagonal_directions = {
-            'Up': [('Up', 'Right'), ('Up', 'Left')],
-            'Down': [('Down', 'Right'), ('Down', 'Left')],
-            'Left': [('Left', 'Up'), ('Left', 'Down')],
-            'Right': [('Right', 'Up'), ('Right', 'Down')]
-        }
-
-        for x in range(self.width):
-            for y in range(self.height):
-                contents = self.grid.get_cell_list_contents((x, y))
-                if self.is_destination(x, y):
-                    # Add edges for destinations
-                    self.add_destination_edges(x, y, directions)
-                elif self.is_road(x, y):
-                    # Add edges for roads, including diagonal edges
-                    road = next((c for c in contents if isinstance(c, Road)), None)
-                    if road:
-                        self.add_road_edges(x, y, road, directions, diagonal_directions)
-                elif self.is_traffic_light(x, y):
-                    self.add_traffic_light_edges(x, y, directions)
-
-    def add_road_edges(self, x, y, road, directions, diagonal_directions):
-        road_directions = road.direction if isinstance(road.direction, list) else [road.direction]
-        for direction in road_directions:
-            dx, dy = directions[direction]
-            nx, ny = x + dx, y + dy
-            if self.valid_position(nx, ny) and not self.is_traffic_light(nx, ny):
-                weight = self.calculate_edge_weight(x, y, nx, ny)
-                self.G.add_edge((x, y), (nx, ny), weight=weight)
-                # Add diagonal edges in the direction of the road
-                if direction in diagonal_directions:
-                    for diag in diagonal_directions[direction]:
-                        ddx, ddy = (directions[diag[0]][0] + directions[diag[1]][0], directions[diag[0]][1] + directions[diag[1]][1])
-                        nnx, nny = x + ddx, y + ddy
-                        if self.valid_position(nnx, nny) and not self.is_traffic_light(nnx, nny):
-                            self.G.add_edge((x, y), (nnx, nny), weight=weight * 3)
-
-    def add_traffic_light_edges(self, x, y, directions):
-        for dir_name, (dx, dy) in directions.items():
-            adjacent_x, adjacent_y = x + dx, y + dy
-
-            if self.valid_position(adjacent_x, adjacent_y) and self.is_road(adjacent_x, adjacent_y):
-                adjacent_contents = self.grid.get_cell_list_contents((adjacent_x, adjacent_y))
-                road = next((c for c in adjacent_contents if isinstance(c, Road)), None)
-                if road:
-                    if self.aligns_with_road_direction(road, x, y, adjacent_x, adjacent_y):
-                        self.G.add_edge((adjacent_x, adjacent_y), (x, y), weight=self.calculate_edge_weight(adjacent_x, adjacent_y, x, y))
-                    else:
-                        self.G.add_edge((x, y), (adjacent_x, adjacent_y), weight=self.calculate_edge_weight(x, y, adjacent_x, adjacent_y))
-
-    def aligns_with_road_direction(self, road, tl_x, tl_y, road_x, road_y):
-        if road.direction == "Up" and road_y < tl_y:
-            return True
-        if road.direction == "Down" and road_y > tl_y:
-            return True
-        if road.direction == "Left" and road_x > tl_x:
-            return True
-        if road.direction == "Right" and road_x < tl_x:
-            return True
-        return False
-
-    def add_destination_edges(self, x, y, directions):
-        for direction in directions.values():
-            dx, dy = direction
-            nx, ny = x + dx, y + dy
-            if self.valid_position(nx, ny) and self.is_road(nx, ny):
-                weight = self.calculate_edge_weight(x, y, nx, ny)
-                self.G.add_edge((nx, ny), (x, y), weight=weight)
+        # Edges and their weight factors (diagonals cost 3) are found by the map compiler.
+        # Returns their weights in CSR order.
+        compiled_map = self.compiled_map
+        nodes = [tuple(node) for node in np.asarray(compiled_map.nodes).tolist()]
+        indices = np.asarray(compiled_map.indices)
+        sources = np.repeat(np.arange(len(nodes)), np.diff(np.asarray(compiled_map.indptr)))
+
+        # Only edges that end on a light depend on its state, index them so a
+        # toggle rewrites those few edges instead of the whole graph
+        self.light_edges = {light.pos: [] for light in self.traffic_lights}
+        targets = np.asarray(compiled_map.nodes)[indices]
+        into_lights = np.flatnonzero(np.asarray(self.light_index)[targets[:, 0], targets[:, 1]] >= 0)
+        into_lights = into_lights[np.argsort(np.asarray(compiled_map.edge_rank)[into_lights], kind='stable')]
+        for u, v in zip(sources[into_lights].tolist(), indices[into_lights].tolist()):
+            self.light_edges[nodes[v]].append((nodes[u], nodes[v]))
+        return self.edge_weights()
 
     def valid_position(self, x, y):
-        return 0 <= x < self.width and 0 <= y < self.height and (self.is_road(x, y) or self.is_traffic_light(x, y) or self.is_destination(x, y))
+        return 0 <= x < self.width and 0 <= y < self.height and self.passable[x, y]
+
+    def edge_weights(self):
+        """
+        calculate_edge_weight times the factor of every edge of the compiled
+        map, in CSR order, worked out for all of them at once.
+        """
+        compiled_map = self.compiled_map
+        targets = np.asarray(compiled_map.nodes)[np.asarray(compiled_map.indices)]
+        lights = np.asarray(self.light_index)[targets[:, 0], targets[:, 1]]
+        # Index -1, no light, reads the green appended at the end
+        green = np.append([light.state for light in self.traffic_lights], True).astype(bool)[lights]
+        weights = np.where(green, 1.0, 10.0)
+        if self.edge_penalty is not None:
+            weights += self.edge_penalty[targets[:, 0], targets[:, 1]]
+        return weights * np.asarray(compiled_map.factors)
 
     def calculate_edge_weight(self, x, y, nx, ny):
         base_weight = 1
-        next_contents = self.grid.get_cell_list_contents((nx, ny))
-        if any(isinstance(c, Traffic_Light) and c.state == False for c in next_contents):
-            return base_weight * 10
-        return base_weight
+        weight = base_weight * 10 if self.is_red_light(nx, ny) else base_weight
+        if self.edge_penalty is not None:
+            weight += float(self.edge_penalty[nx, ny])
+        return weight
+
+    def reweight_edges(self):
+        # Sets every edge to its current weight, for when more than the lights changed
+        weights = self.edge_weights()[np.argsort(self.compiled_map.edge_rank, kind='stable')].tolist()
+        for ((x, y), (nx, ny), _), weight in zip(self.compiled_map.edges(), weights):
+            if self.graph.weight((x, y), (nx, ny)) != weight:
+                self.graph.set_weight((x, y), (nx, ny), weight)
+
+    def cell_occupancy(self):
+        # Cars per cell indexed [x, y], whichever engine moves them
+        if self.engine is not None:
+            return self.engine.occupancy()
+        return self.occupancy
+
+    def update_congestion_costs(self):
+        """
+        Turns the congestion estimate into edge costs, rebuilds the route
+        trees against them and has every car re-route.
+        """
+        self.edge_penalty = self.congestion.penalties()
+        self.reweight_edges()
+        self.routes.invalidate()
+        self.route_epoch += 1
+        if self.engine is not None:
+            self.engine.reroute()
 
     def visualize_graph(self):
         pos = {node: (node[0], - node[1]) for node in self.G.nodes()}
@@ -189,23 +362,140 @@ class CityModel(Model):
         plt.show()
 
     def step(self):
-        self.schedule.step()
-        if self.schedule.steps % 3 == 1:
-            self.place_single_car()
-
-        # Make a post request to the server every 100 steps
-        if self.schedule.steps % 100 == 0:
-            post(self.arrived_agents)
-
-        if self.schedule.steps == 1000:
+        profiler = self.profiler
+        # The step's light changes reach the graph in one update, before any car moves
+        with phase(profiler, "lights"):
+            for light in self.light_scheduler.due(self.schedule.steps):
+                light.toggle()
+        with phase(profiler, "light_updates"):
+            self.flush_edge_weight_updates()
+        with phase(profiler, "schedule"):
+            self.schedule.step()
+        if self.engine is not None:
+            with phase(profiler, "engine"):
+                self.engine.step()
+        if self.demand is not None:
+            with phase(profiler, "spawning"):
+                self.add_cars(*self.demand.spawns(self.schedule.steps))
+        elif self.schedule.steps % self.spawn_every == 1 % self.spawn_every:
+            with phase(profiler, "spawning"):
+                self.place_single_car()
+        if self.congestion is not None:
+            with phase(profiler, "congestion"):
+                self.congestion.observe(self.cell_occupancy())
+                if self.congestion.due(self.schedule.steps):
+                    self.update_congestion_costs()
+
+        # Report to the metrics sink every 100 steps, it never blocks the step
+        if self.metrics is not None and self.schedule.steps % 100 == 0:
+            with phase(profiler, "metrics"):
+                self.metrics.emit({"step": self.schedule.steps, "num_cars": self.arrived_agents})
+
+        if self.change_log is not None:
+            with phase(profiler, "change_tracking"):
+                self.record_changes()
+
+        if profiler is not None:
+            profiler.steps += 1
+
+        if self.schedule.steps == self.max_steps:
             self.running = False
+            if profiler is not None:
+                logger.info("Profile at the end of the run:\n%s", profiler.summary())
+
+    def fast_forward(self, n_steps):
+        """
+        Runs up to n_steps steps headless: nothing goes to the metrics sink
+        and no changes are recorded. A change log that was on starts over
+        from the new state, so delta clients get a full update next.
+        """
+        metrics, change_log = self.metrics, self.change_log
+        self.metrics = self.change_log = None
+        try:
+            for _ in range(n_steps):
+                if not self.running:
+                    break
+                self.step()
+        finally:
+            self.metrics = metrics
+            if change_log is not None:
+                self.enable_change_tracking(change_log.maxlen)
+
+    def close(self):
+        # Stops the worker processes of the partitioned engine and the metrics
+        # sink's thread, after it had up to 5 s to write what it still holds
+        if self.engine is not None and hasattr(self.engine, "close"):
+            self.engine.close()
+        if self.metrics is not None:
+            self.metrics.flush(timeout=5)
+            self.metrics.close()
+            self.metrics = None
+
+    def enable_change_tracking(self, history=100):
+        # Keep what changed in each of the last `history` steps
+        if self.change_log is None:
+            self.change_log = deque(maxlen=history)
+            self.last_positions = self.car_positions()
+            self.last_lights = {light.unique_id: light.state for light in self.traffic_lights}
+
+    def car_positions(self):
+        return {car["id"]: (car["x"], car["y"]) for car in self.get_agent_data()}
+
+    def record_changes(self):
+        positions = self.car_positions()
+        cars = {car_id: pos for car_id, pos in positions.items() if self.last_positions.get(car_id) != pos}
+        arrived = [car_id for car_id in self.last_positions if car_id not in positions]
+        lights = {light.unique_id: light.state for light in self.traffic_lights if self.last_lights[light.unique_id] != light.state}
+        self.change_log.append((self.schedule.steps, cars, arrived, lights))
+        self.last_positions = positions
+        self.last_lights.update(lights)
+
+    def get_changes_since(self, step):
+        """
+        Cars that moved, spawned or arrived and lights that changed after
+        `step`. None when that step is no longer in the change log.
+        """
+        if self.change_log is None or step is None or step > self.schedule.steps:
+            return None
+        oldest = self.change_log[0][0] - 1 if self.change_log else self.schedule.steps
+        if step < oldest:
+            return None
+        cars, arrived, lights = {}, [], {}
+        for logged_step, step_cars, step_arrived, step_lights in self.change_log:
+            if logged_step <= step:
+                continue
+            cars.update(step_cars)
+            for car_id in step_arrived:
+                cars.pop(car_id, None)
+                arrived.append(car_id)
+            lights.update(step_lights)
+        semaphores = [semaphore for semaphore in self.get_semaphores() if semaphore["id"] in lights]
+        return {
+            "cars": [{"id": car_id, "x": x, "y": y, "arrived": False} for car_id, (x, y) in cars.items()],
+            "arrived": arrived,
+            "semaphores": semaphores,
+        }
 
     def update_graph_edge_weights(self, agent):
-        for edge in self.G.edges:
-            start_node, end_node = edge
-            start_x, start_y = start_node
-            end_x, end_y = end_node
-            self.G.edges[edge]['weight'] = self.calculate_edge_weight(start_x, start_y, end_x, end_y)
+        # Queue the light, all the toggles of a step are applied in a single pass
+        self.pending_lights.add(agent.pos)
+
+    def flush_edge_weight_updates(self):
+        changed = []
+        for pos in self.pending_lights:
+            for edge in self.light_edges.get(pos, []):
+                (start_x, start_y), (end_x, end_y) = edge
+                weight = self.calculate_edge_weight(start_x, start_y, end_x, end_y)
+                if self.graph.weight(*edge) != weight:
+                    self.graph.set_weight(*edge, weight)
+                    changed.append(edge)
+        self.pending_lights.clear()
+        if changed:
+            count(self.profiler, "graph_updates", len(changed))
+            # With congestion routing the trees are a snapshot refreshed
+            # every `congestion_every` steps, lights included
+            if self.congestion is None:
+                self.routes.update_edges(changed)
 
     def recalculate_paths(self):
         for agent in self.schedule.agents:
@@ -213,10 +503,11 @@ class CityModel(Model):
                 agent.recalculate_path()
 
     def is_traffic_light(self, x, y):
-        contents = self.grid.get_cell_list_contents((x, y))
-        return any(isinstance(content, Traffic_Light) for content in contents)
+        return self.cell_types[x, y] == TRAFFIC_LIGHT
 
     def get_agent_data(self):
+        if self.engine is not None:
+            return self.engine.get_agent_data()
         agent_data = []
         for agent in self.schedule.agents:
             if isinstance (agent, Car):
@@ -229,8 +520,9 @@ class CityModel(Model):
                 agent_data.append(agent_info)
         return agent_data
 
-    def generate_graph_for_car(self, car_id):
-        return self.G.copy()
+    def generate_overlay_for_car(self, car_id):
+        # Cars share the road graph, only their own extra costs are stored per car
+        return CostOverlay()
 
     def get_semaphores(self):
         semaphore_data = []
@@ -245,29 +537,6 @@ class CityModel(Model):
         return semaphore_data
 
 
-def post(num_cars):
-    url = "http://52.1.3.19:8585/api/"
-    endpoint = "attempts"
-
-    data = {
-        "year" : 2023,
-        "classroom" : 302,
-        "name" : "Equipo BBT",
-        "num_cars": num_cars,
-    }
-
-    headers = {
-        "Content-Type": "application/json"
-    }
-
-    response = requests.post(url+endpoint, data=json.dumps(data), headers=headers)
-    if response.status_code == 200:
-        print("Request successful")
-    else:
-        print("Request failed")
-    print("Request " + "successful" if response.status_code == 200 else "failed", "Status code:", response.status_code)
-    print("Response:", response.json())
-
 if __name__ == "__main__":
     model = CityModel(N=1)
     model.add_edges()
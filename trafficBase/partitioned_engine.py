@@ -0,0 +1,343 @@
+#partitioned_engine.py
+# Car engine for large maps split over worker processes,
+# CityModel(N, engine="partitioned", workers=8).
+#
+# The grid is cut into vertical strips with about the same number of road
+# cells, each owned by a worker that steps its cars with an ArrayCarEngine.
+# The model keeps the lights and spawning and steps every worker in lockstep.
+# Workers share, through shared memory:
+#   lights     light states, written by the model before each step
+#   occupancy  cars per cell, each worker writes the cells of its strip
+#   outbox     cars leaving a strip, one record per car with its path
+#   accepted   which of those cars the owner of the cell took
+# Each worker routes on its own copy of the weights, the graph arrays come
+# from the compiled map, memory-mapped and shared through the page cache.
+import multiprocessing
+import os
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from array_engine import ArrayCarEngine
+
+RECORD_HEADER = 5  # number, target cell, destination cell, owner, path length, then the path
+
+
+def split_columns(passable, parts):
+    """
+    Strip of every column, parts strips with about as many passable cells.
+    """
+    counts = np.asarray(passable).sum(axis=1)
+    cumulative = np.cumsum(counts)
+    bounds = np.searchsorted(cumulative, np.arange(1, parts) * cumulative[-1] / parts, side='right')
+    return np.searchsorted(bounds, np.arange(len(counts)), side='right')
+
+
+def shared_array(shape, dtype, name=None):
+    # New block when name is None, otherwise attach to the block of that name
+    dtype = np.dtype(dtype)
+    if name is None:
+        memory = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    else:
+        memory = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    if name is None:
+        array[...] = 0
+    return memory, array
+
+
+class PartitionedCarEngine:
+    """
+    Same interface as ArrayCarEngine. Inside a strip cars follow the array
+    engine rules; a car moving into another strip asks its owner, which
+    accepts it after its own cars moved if the cell is still free, so cars
+    crossing a boundary give way to the cars already there. Results depend
+    on the number of workers, not on how fast they run.
+    """
+    def __init__(self, model, workers=None, buffer_cells=1 << 20, max_requests=1 << 14):
+        self.model = model
+        self.height = model.height
+        self.workers = max(1, min(workers or os.cpu_count(), model.width))
+        self.cell_owner = np.repeat(split_columns(model.passable, self.workers), model.height)
+        self.blocks = []
+        self.closed = False
+        self.shapes = shapes = {
+            "lights": ((len(model.traffic_lights),), bool),
+            "occupancy": ((model.width * model.height,), np.uint16),
+            "outbox": ((self.workers, buffer_cells), np.int64),
+            "outbox_count": ((self.workers,), np.int64),
+            "accepted": ((self.workers, max_requests), bool),
+        }
+        names = {}
+        for key, (shape, dtype) in shapes.items():
+            memory, array = shared_array(shape, dtype)
+            self.blocks.append(memory)
+            names[key] = (memory.name, shape, np.dtype(dtype).str)
+            setattr(self, key, array)
+        self.lights[:] = [light.state for light in model.traffic_lights]
+
+        context = multiprocessing.get_context("spawn")
+        self.barrier = barrier = context.Barrier(self.workers)  # Kept alive until the workers attach
+        seed = model.random.getrandbits(64)
+        self.connections, self.processes = [], []
+        for index in range(self.workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=run_worker, daemon=True, args=(
+                index, self.workers, model.params["map_file"], model.dataDictionary, names, self.cell_owner,
+                seed + index, model.params["routing"], barrier, worker_connection))
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.finalizer = weakref.finalize(self, shutdown, self.connections, self.processes, self.blocks)
+
+    def cell(self, x, y):
+        return x * self.height + y
+
+    def __len__(self):
+        return sum(self.ask(("count", None)))
+
+    def check_open(self):
+        if self.closed:
+            raise RuntimeError("The partitioned engine is closed, its workers and shared memory are gone")
+
+    def ask(self, message):
+        self.check_open()
+        for connection in self.connections:
+            connection.send(message)
+        return [connection.recv() for connection in self.connections]
+
+    def add_car(self, number, start, destination):
+        self.add_cars([number], [start], [destination])
+
+    def add_cars(self, numbers, starts, destinations):
+        self.check_open()
+        owners = self.cell_owner[[self.cell(*start) for start in starts]]
+        for index in np.unique(owners).tolist():
+            rows = np.flatnonzero(owners == index).tolist()
+            self.connections[index].send(("add", ([numbers[row] for row in rows], [starts[row] for row in rows],
+                                                  [destinations[row] for row in rows])))
+
+    def step(self):
+        self.check_open()
+        self.lights[:] = [light.state for light in self.model.traffic_lights]
+        arrived = sum(self.ask(("step", None)))
+        self.model.active_agents -= arrived
+        self.model.arrived_agents += arrived
+
+    def get_agent_data(self):
+        return [
+            {"id": f"car_{number}", "x": x, "y": y, "arrived": False}
+            for cars in self.ask(("data", None)) for number, x, y in cars
+        ]
+
+    def close(self):
+        # The views over the shared blocks go first, nothing may read them once unmapped
+        self.closed = True
+        for key in self.shapes:
+            setattr(self, key, None)
+        self.finalizer()
+
+
+def shutdown(connections, processes, blocks):
+    for connection in connections:
+        try:
+            connection.send(("close", None))
+        except OSError:
+            pass
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+    for memory in blocks:
+        memory.close()
+        memory.unlink()
+
+
+class SharedLight:
+    # Traffic_Light stand-in for the workers, its state lives in shared memory
+    def __init__(self, states, index, pos):
+        self.states = states
+        self.index = index
+        self.pos = pos
+
+    @property
+    def state(self):
+        return bool(self.states[self.index])
+
+
+class TileModel:
+    """
+    What an ArrayCarEngine reads from its model, for the engine of a strip.
+    """
+    def __init__(self, compiled_map, lights, routes):
+        self.width, self.height = compiled_map.width, compiled_map.height
+        self.passable = compiled_map.passable
+        self.traffic_lights = [SharedLight(lights, i, tuple(pos)) for i, pos in enumerate(compiled_map.light_cells.tolist())]
+        self.routes = routes
+        self.profiler = None
+        self.active_agents = 0
+        self.arrived_agents = 0
+
+
+class Tile:
+    """
+    Worker side: the cars of one strip and the routes they plan with.
+    """
+    def __init__(self, index, workers, compiled_map, arrays, cell_owner, seed, routing, barrier):
+        from graph_backend import CSRBackend
+        from routes import make_routes
+
+        self.index = index
+        self.workers = workers
+        self.barrier = barrier
+        for key, array in arrays.items():
+            setattr(self, key, array)
+        self.cell_owner = cell_owner
+        self.owned_cells = np.flatnonzero(cell_owner == index)
+
+        # Edge weights as CityModel sets them, factor times 10 into a red light
+        self.factors = np.asarray(compiled_map.factors, dtype=np.float64)
+        self.light_index = compiled_map.light_index
+        targets = np.asarray(compiled_map.nodes)[np.asarray(compiled_map.indices)]
+        target_lights = self.light_index[targets[:, 0], targets[:, 1]]
+        self.light_states = self.lights.copy()
+        red = (target_lights >= 0) & ~self.light_states[np.maximum(target_lights, 0)]
+        self.graph = CSRBackend(compiled_map, None, weights=self.factors * np.where(red, 10, 1))
+        destinations = [tuple(destination) for destination in compiled_map.destinations.tolist()]
+        lights = [tuple(light) for light in compiled_map.light_cells.tolist()]
+        self.model = TileModel(compiled_map, self.lights, make_routes(routing, self.graph, destinations, lights))
+
+        self.engine = ArrayCarEngine(self.model, seed=seed)
+        self.engine.owned = cell_owner == index
+        self.light_ids = [self.graph.ids[light.pos] for light in self.model.traffic_lights]
+
+    def update_lights(self):
+        states = self.lights.copy()
+        changed = []
+        graph = self.graph
+        for light in np.flatnonzero(states != self.light_states).tolist():
+            node = self.light_ids[light]
+            for position in range(graph.rindptr_list[node], graph.rindptr_list[node + 1]):
+                edge = graph.redges_list[position]
+                u, v = graph.nodes[graph.rindices_list[position]], graph.nodes[node]
+                graph.set_weight(u, v, self.factors[edge] * (1 if states[light] else 10))
+                changed.append((u, v))
+        self.light_states = states
+        if changed:
+            self.model.routes.update_edges(changed)
+
+    def publish(self):
+        engine = self.engine
+        rows = np.flatnonzero(engine.active[:engine.size])
+        cells = engine.x[rows].astype(np.int64) * engine.height + engine.y[rows]
+        self.occupancy[self.owned_cells] = np.bincount(cells, minlength=engine.cells)[self.owned_cells]
+
+    def add(self, numbers, starts, destinations):
+        self.engine.add_cars(numbers, starts, destinations)
+        self.model.active_agents += len(numbers)
+        self.publish()
+
+    def step(self):
+        engine = self.engine
+        self.update_lights()
+        arrived = self.model.arrived_agents
+        self.barrier.wait()  # Every strip published its cars
+
+        external = self.occupancy.astype(np.int64)
+        external[self.owned_cells] = 0
+        engine.external = external
+        engine.step()
+        self.send_requests()
+        self.barrier.wait()
+
+        arrived_here = self.accept_requests()
+        self.barrier.wait()
+
+        leaving = self.accepted[self.index, :len(engine.requests)].copy()
+        self.model.active_agents -= int(leaving.sum())
+        engine.settle_requests(leaving)
+        self.publish()
+        return self.model.arrived_agents - arrived + arrived_here
+
+    def send_requests(self):
+        engine = self.engine
+        outbox = self.outbox[self.index]
+        self.accepted[self.index] = False
+        used = sent = 0
+        for row in engine.requests.tolist():
+            cursor, end = int(engine.cursor[row]), int(engine.path_end[row])
+            target = int(engine.path_cells[cursor])
+            length = end - cursor - 1
+            if sent == self.accepted.shape[1] or used + RECORD_HEADER + length > len(outbox):
+                break  # Full, the rest try again next step
+            outbox[used:used + RECORD_HEADER] = (engine.numbers[row], target, engine.destination[row],
+                                                 self.cell_owner[target], length)
+            outbox[used + RECORD_HEADER:used + RECORD_HEADER + length] = engine.path_cells[cursor + 1:end]
+            used += RECORD_HEADER + length
+            sent += 1
+        self.outbox_count[self.index] = sent
+
+    def accept_requests(self):
+        # Cars from other strips, in strip order, take the cells left free
+        engine = self.engine
+        rows = np.flatnonzero(engine.active[:engine.size])
+        taken = np.bincount(engine.x[rows].astype(np.int64) * engine.height + engine.y[rows], minlength=engine.cells)
+        arrived = 0
+        for sender in range(self.workers):
+            if sender == self.index:
+                continue
+            outbox = self.outbox[sender]
+            used = 0
+            for k in range(int(self.outbox_count[sender])):
+                number, target, destination, owner, length = outbox[used:used + RECORD_HEADER].tolist()
+                path = outbox[used + RECORD_HEADER:used + RECORD_HEADER + length]
+                used += RECORD_HEADER + length
+                if owner != self.index or taken[target]:
+                    continue
+                self.accepted[sender, k] = True
+                if target == destination:
+                    arrived += 1
+                    continue
+                taken[target] += 1
+                engine.adopt_car(number, target, destination, path)
+                self.model.active_agents += 1
+        return arrived
+
+    def cars(self):
+        engine = self.engine
+        rows = np.flatnonzero(engine.active[:engine.size])
+        return list(zip(engine.numbers[rows].tolist(), engine.x[rows].tolist(), engine.y[rows].tolist()))
+
+
+def run_worker(index, workers, map_file, dictionary, names, cell_owner, seed, routing, barrier, connection):
+    from map_compiler import load_map
+
+    blocks, arrays = [], {}
+    for key, (name, shape, dtype) in names.items():
+        memory, arrays[key] = shared_array(shape, dtype, name)
+        blocks.append(memory)
+    tile = Tile(index, workers, load_map(map_file, dictionary), arrays, cell_owner, seed, routing, barrier)
+    try:
+        while True:
+            command, payload = connection.recv()
+            if command == "add":
+                tile.add(*payload)
+            elif command == "step":
+                connection.send(tile.step())
+            elif command == "data":
+                connection.send(tile.cars())
+            elif command == "count":
+                connection.send(tile.model.active_agents)
+            elif command == "close":
+                break
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        arrays.clear()
+        tile = None
+        for memory in blocks:
+            try:
+                memory.close()
+            except BufferError:
+                pass  # Still viewed by a frame of the traceback, freed on exit
@@ -0,0 +1,85 @@
+#profiling.py
+# Opt-in timing of CityModel.step, CityModel(N, profile=True).
+# The model and its parts call phase() and count() with model.profiler,
+# which is None unless profiling is on, so the hooks cost next to nothing
+# by default.
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+NO_PHASE = nullcontext()
+
+
+def phase(profiler, name):
+    """
+    Context manager timing `name` on profiler, a no-op when it is None.
+    """
+    return NO_PHASE if profiler is None else profiler.phase(name)
+
+
+def count(profiler, name, n=1):
+    if profiler is not None:
+        profiler.counters[name] += n
+
+
+class StepProfiler:
+    """
+    Wall time per phase and event counters. Phases nest and the time of a
+    phase excludes the phases started inside it, e.g. the "schedule" phase
+    is what RandomActivation spends outside "pathfinding" and "movement",
+    so the phases of a step add up to the whole step.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)  # Phase -> exclusive seconds
+        self.calls = Counter()
+        self.counters = Counter()
+        self.steps = 0
+        self.stack = []
+        self.started = 0.0  # When the innermost phase last resumed
+
+    def start(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self.seconds[self.stack[-1]] += now - self.started
+        self.stack.append(name)
+        self.started = now
+
+    def stop(self):
+        now = time.perf_counter()
+        name = self.stack.pop()
+        self.seconds[name] += now - self.started
+        self.calls[name] += 1
+        self.started = now
+
+    @contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def snapshot(self):
+        steps = max(self.steps, 1)
+        return {
+            "steps": self.steps,
+            "seconds": sum(self.seconds.values()),
+            "phases": {name: {"seconds": seconds, "calls": self.calls[name], "ms_per_step": 1000 * seconds / steps}
+                       for name, seconds in sorted(self.seconds.items(), key=lambda item: -item[1])},
+            "counters": dict(self.counters),
+        }
+
+    def summary(self):
+        snapshot = self.snapshot()
+        total = snapshot["seconds"] or 1.0
+        lines = [f"{snapshot['steps']} steps in {snapshot['seconds']:.3f} s",
+                 f"{'phase':<16} {'seconds':>9} {'share':>6} {'ms/step':>9} {'calls':>9}"]
+        for name, stats in snapshot["phases"].items():
+            lines.append(f"{name:<16} {stats['seconds']:>9.3f} {stats['seconds'] / total:>6.1%} "
+                         f"{stats['ms_per_step']:>9.3f} {stats['calls']:>9}")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"{name:<26} {value:>12}")
+        return "\n".join(lines)
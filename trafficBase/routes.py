@@ -0,0 +1,278 @@
+#routes.py
+import heapq
+import math
+
+import networkx as nx
+import numpy as np
+
+from profiling import count
+
+
+class RouteService:
+    """
+    Shortest paths to every destination answered by lookup.
+    For each destination a reverse shortest path tree from the graph backend
+    stores the next hop and the remaining cost of every node that can reach
+    it. Trees are built lazily and only the ones a weight change can affect
+    are dropped.
+    """
+    VECTOR_MIN = 256  # Starts from which node_paths walks them as arrays, below it a loop is faster
+
+    def __init__(self, graph, destinations, profiler=None):
+        self.graph = graph  # A graph_backend
+        self.profiler = profiler
+        self.destinations = set(destinations)
+        self.trees = {}  # destination -> (next_hop, distance) indexed by node id
+        self.hop_arrays = {}  # destination -> (tree, next_hop as an array), for node_paths
+        self.builds = 0
+
+    def covers(self, destination):
+        return destination in self.destinations
+
+    def tree(self, destination):
+        tree = self.trees.get(destination)
+        if tree is None:
+            tree = self.trees[destination] = self.graph.reverse_tree(destination)
+            self.builds += 1
+            count(self.profiler, "route_tree_builds")
+        return tree
+
+    def path(self, start, destination):
+        """
+        Path from start to destination, both included, like nx.astar_path.
+        """
+        count(self.profiler, "route_lookups")
+        next_hop, _ = self.tree(destination)
+        node = self.graph.ids.get(start)
+        target = self.graph.ids[destination]
+        if node is None or (node != target and next_hop[node] < 0):
+            raise nx.NetworkXNoPath(f"No path between {start} and {destination}.")
+        nodes = self.graph.nodes
+        path = [start]
+        while node != target:
+            node = next_hop[node]
+            path.append(nodes[node])
+        return path
+
+    def node_paths(self, starts, destination):
+        """
+        Paths from many starts to one destination as arrays of node ids,
+        both ends included, None for the starts that can't reach it. From
+        VECTOR_MIN starts on they walk the destination's tree together.
+        """
+        count(self.profiler, "route_lookups", len(starts))
+        tree = self.tree(destination)
+        target = self.graph.ids[destination]
+        ids = self.graph.ids
+        if len(starts) < self.VECTOR_MIN:
+            next_hop = tree[0]
+            paths = []
+            for start in starts:
+                node = ids.get(start)
+                if node is None or (node != target and next_hop[node] < 0):
+                    paths.append(None)
+                    continue
+                path = [node]
+                while node != target:
+                    node = next_hop[node]
+                    path.append(node)
+                paths.append(np.array(path, dtype=np.int64))
+            return paths
+        cached = self.hop_arrays.get(destination)
+        if cached is None or cached[0] is not tree:
+            cached = self.hop_arrays[destination] = (tree, np.array(tree[0], dtype=np.int64))
+        next_hop = cached[1]
+        nodes = np.array([ids.get(start, -1) for start in starts], dtype=np.int64)
+        reachable = (nodes == target) | ((nodes >= 0) & (next_hop[nodes] >= 0))
+        walk = [nodes]
+        current = nodes
+        moving = reachable & (current != target)
+        while moving.any():
+            current = np.where(moving, next_hop[current], current)
+            walk.append(current)
+            moving &= current != target
+        walk = np.stack(walk, axis=1)
+        lengths = np.argmax(walk == target, axis=1) + 1
+        return [walk[i, :lengths[i]] if reachable[i] else None for i in range(len(starts))]
+
+    def update_edges(self, edges):
+        """
+        Patch after the weights of edges changed. A tree stays valid unless one
+        of its own edges changed or a changed edge is now a shortcut.
+        """
+        ids = self.graph.ids
+        changed = [(ids[u], ids[v], self.graph.weight(u, v)) for u, v in edges]
+        for destination, (next_hop, distance) in list(self.trees.items()):
+            for u, v, weight in changed:
+                if next_hop[u] == v or distance[v] + weight < distance[u]:
+                    del self.trees[destination]
+                    count(self.profiler, "route_trees_dropped")
+                    break
+
+    def invalidate(self):
+        self.trees.clear()
+        self.hop_arrays.clear()
+
+
+class ZoneRouteService(RouteService):
+    """
+    RouteService for large tiled maps, CityModel(N, routing="zones").
+    The edges into the lights cut the road graph into blocks whose weights
+    only change with the congestion costs. Within the blocks the distance and
+    first hop from every node to the edges out of its block and to the
+    destinations are worked out once; a tree is then the distances between
+    the lights, relaxed as arrays on that small graph under the current light
+    states, spread to every node from the tables. Same trees as
+    reverse_tree, except for the hop taken between paths of equal cost.
+    Needs the csr backend.
+    """
+    def __init__(self, graph, destinations, lights, profiler=None):
+        if graph.name != "csr":
+            raise ValueError("Zone routing needs the csr graph backend")
+        super().__init__(graph, destinations, profiler)
+        self.lights = list(lights)
+        self.tables = None  # Built on the first tree and after invalidate
+
+    def block_search(self, target, cut):
+        """
+        (nodes, distance, next_hop) of the nodes that reach target without
+        taking a cut edge, next_hop is -1 for target itself.
+        """
+        rindptr, rindices, redges, weights = self.graph.rindptr_list, self.graph.rindices_list, \
+            self.graph.redges_list, self.graph.weights_list
+        distance = {target: 0}
+        next_hop = {target: -1}
+        done = set()
+        queue = [(0, 0, target)]
+        counter = 1
+        while queue:
+            cost, _, node = heapq.heappop(queue)
+            if node in done:
+                continue
+            done.add(node)
+            for position in range(rindptr[node], rindptr[node + 1]):
+                edge = redges[position]
+                if cut[edge]:
+                    continue
+                previous = rindices[position]
+                new_cost = cost + weights[edge]
+                if new_cost < distance.get(previous, math.inf):
+                    distance[previous] = new_cost
+                    next_hop[previous] = node
+                    heapq.heappush(queue, (new_cost, counter, previous))
+                    counter += 1
+        nodes = list(distance)
+        return nodes, [distance[node] for node in nodes], [next_hop[node] for node in nodes]
+
+    def build_tables(self):
+        graph = self.graph
+        count(self.profiler, "route_table_builds")
+        light_ids = np.array([graph.ids[light] for light in self.lights], dtype=np.int64)
+        light_of = np.full(len(graph.nodes), -1, dtype=np.int64)
+        light_of[light_ids] = np.arange(len(light_ids))
+        sources = np.repeat(np.arange(len(graph.nodes)), np.diff(graph.indptr))
+        # Cut edges end on a light, the only edges whose weight a toggle changes
+        cut = light_of[graph.indices] >= 0
+        cut_edges = np.flatnonzero(cut)
+        cut_list = cut.tolist()
+
+        # Entry: a node, the cut edge it leaves its block by, the distance to
+        # the tail of that edge and the first hop towards it
+        node_parts, cut_parts, prefix_parts, hop_parts = [], [], [], []
+        for tail in np.unique(sources[cut_edges]).tolist():
+            nodes, distance, next_hop = self.block_search(tail, cut_list)
+            for index in np.flatnonzero(sources[cut_edges] == tail).tolist():
+                hops = np.array(next_hop, dtype=np.int64)
+                hops[0] = graph.indices_list[cut_edges[index]]
+                node_parts.append(np.array(nodes, dtype=np.int64))
+                cut_parts.append(np.full(len(nodes), index, dtype=np.int64))
+                prefix_parts.append(np.array(distance, dtype=np.float64))
+                hop_parts.append(hops)
+        entry_node = np.concatenate(node_parts + [np.zeros(0, dtype=np.int64)])
+        order = np.argsort(entry_node, kind="stable")
+        entry_node = entry_node[order]
+        entry_cut = np.concatenate(cut_parts + [np.zeros(0, dtype=np.int64)])[order].astype(np.int32)
+        entry_prefix = np.concatenate(prefix_parts + [np.zeros(0)])[order]
+        entry_hop = np.concatenate(hop_parts + [np.zeros(0, dtype=np.int64)])[order]
+        # Entries of a node are a segment, reduced together
+        segments = np.flatnonzero(np.diff(entry_node, prepend=-1) != 0)
+        entry_segment = (np.cumsum(np.diff(entry_node, prepend=-1) != 0) - 1).astype(np.int32)
+
+        # Arcs of the light graph are the entries of the lights, grouped by the light they lead to
+        cut_light = light_of[graph.indices[cut_edges]]
+        arcs = np.flatnonzero(light_of[entry_node] >= 0)
+        arcs = arcs[np.argsort(cut_light[entry_cut[arcs]], kind="stable")]
+        arc_ptr = np.searchsorted(cut_light[entry_cut[arcs]], np.arange(len(light_ids) + 1))
+
+        # Destinations reached inside their own block
+        local = {destination: tuple(np.array(part) for part in self.block_search(graph.ids[destination], cut_list))
+                 for destination in self.destinations}
+        self.tables = {"light_of": light_of, "cut_edges": cut_edges, "cut_light": cut_light,
+                       "entry_cut": entry_cut, "entry_prefix": entry_prefix, "entry_hop": entry_hop,
+                       "entry_segment": entry_segment, "segments": segments, "segment_nodes": entry_node[segments],
+                       "arc_source": light_of[entry_node[arcs]], "arc_prefix": entry_prefix[arcs],
+                       "arc_cut": entry_cut[arcs], "arc_ptr": arc_ptr, "local": local}
+
+    def tree(self, destination):
+        tree = self.trees.get(destination)
+        if tree is None:
+            tree = self.trees[destination] = self.zone_tree(destination)
+            self.builds += 1
+            count(self.profiler, "route_tree_builds")
+        return tree
+
+    def zone_tree(self, destination):
+        if self.tables is None:
+            self.build_tables()
+        tables = self.tables
+        light_of, cut_light, arc_source, arc_ptr = tables["light_of"], tables["cut_light"], tables["arc_source"], \
+            tables["arc_ptr"]
+        local_nodes, local_distance, local_hop = tables["local"][destination]
+        cut_weight = self.graph.weights[tables["cut_edges"]]
+        arc_cost = tables["arc_prefix"] + cut_weight[tables["arc_cut"]]
+
+        # Light to destination distances, relaxed from the lights that improved
+        # until none does, starting from the lights inside the destination's block
+        remaining = np.full(len(self.lights), math.inf)
+        in_block = light_of[local_nodes] >= 0
+        remaining[light_of[local_nodes[in_block]]] = local_distance[in_block]
+        improved = np.flatnonzero(np.isfinite(remaining))
+        while len(improved):
+            starts, lengths = arc_ptr[improved], arc_ptr[improved + 1] - arc_ptr[improved]
+            picked = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            candidate = arc_cost[picked] + np.repeat(remaining[improved], lengths)
+            sources = arc_source[picked]
+            better = candidate < remaining[sources]
+            np.minimum.at(remaining, sources[better], candidate[better])
+            improved = np.unique(sources[better])
+
+        # Every node takes its cheapest way out of its block, or the way inside it
+        distance = np.full(len(self.graph.nodes), math.inf)
+        next_hop = np.full(len(self.graph.nodes), -1, dtype=np.int64)
+        segments = tables["segments"]
+        if len(segments):
+            cost = tables["entry_prefix"] + (cut_weight + remaining[cut_light])[tables["entry_cut"]]
+            best = np.minimum.reduceat(cost, segments)
+            hit = np.flatnonzero(cost == best[tables["entry_segment"]])
+            first = hit[np.diff(tables["entry_segment"][hit], prepend=-1) != 0]
+            reachable = np.isfinite(best)
+            nodes = tables["segment_nodes"][reachable]
+            distance[nodes] = best[reachable]
+            next_hop[nodes] = tables["entry_hop"][first[reachable]]
+        closer = local_distance <= distance[local_nodes]
+        distance[local_nodes[closer]] = local_distance[closer]
+        next_hop[local_nodes[closer]] = local_hop[closer]
+        return next_hop.tolist(), distance.tolist()
+
+    def invalidate(self):
+        # The congestion costs changed the weights inside the blocks too
+        super().invalidate()
+        self.tables = None
+
+
+def make_routes(name, graph, destinations, lights, profiler=None):
+    if name == "trees":
+        return RouteService(graph, destinations, profiler)
+    if name == "zones":
+        return ZoneRouteService(graph, destinations, lights, profiler)
+    raise ValueError(f"Unknown routing {name!r}, use 'trees' or 'zones'")
@@ -1,6 +1,7 @@
 #server.py
 from agent import *
 from model import CityModel
+from collections import defaultdict
 from mesa.visualization import CanvasGrid, BarChartModule
 from mesa.visualization import ModularServer
 
@@ -20,11 +21,11 @@ def agent_portrayal(agent):
         portrayal["w"] = 0.8
         portrayal["h"] = 0.8
 
-    if (isinstance(agent, Road)):
+    if (isinstance(agent, Road) or (isinstance(agent, StaticCell) and agent.kind == "road")):
         portrayal["Color"] = "grey"
         portrayal["Layer"] = 0
 
-    if (isinstance(agent, Destination)):
+    if (isinstance(agent, Destination) or (isinstance(agent, StaticCell) and agent.kind == "destination")):
         portrayal["Color"] = "lightgreen"
         portrayal["Layer"] = 0
 
@@ -34,7 +35,7 @@ def agent_portrayal(agent):
         portrayal["w"] = 0.8
         portrayal["h"] = 0.8
 
-    if (isinstance(agent, Obstacle)):
+    if (isinstance(agent, Obstacle) or (isinstance(agent, StaticCell) and agent.kind == "obstacle")):
         portrayal["Color"] = "cadetblue"
         portrayal["Layer"] = 0
         portrayal["w"] = 0.8
@@ -42,6 +43,28 @@ def agent_portrayal(agent):
 
     return portrayal
 
+class LayeredCanvasGrid(CanvasGrid):
+    """
+    CanvasGrid that also draws the roads, obstacles and destinations of a
+    model built with static_agents=False, which are not on the grid.
+    """
+    def render(self, model):
+        if model.static_agents:
+            return super().render(model)
+        grid_state = defaultdict(list)
+        for x in range(model.grid.width):
+            for y in range(model.grid.height):
+                static = model.static_cell(x, y)
+                cell_objects = model.grid.get_cell_list_contents([(x, y)])
+                for obj in ([static] if static else []) + cell_objects:
+                    portrayal = self.portrayal_method(obj)
+                    if portrayal:
+                        portrayal["x"] = x
+                        portrayal["y"] = y
+                        grid_state[portrayal["Layer"]].append(portrayal)
+
+        return grid_state
+
 width = 0
 height = 0
 
@@ -53,10 +76,10 @@ with open('city_files/2022_base.txt') as baseFile:
     width = len(lines[0])
     height = len(lines)
 
-model_params = {"N":1}
+model_params = {"N":1, "static_agents": False}
 
 print(width, height)
-grid = CanvasGrid(agent_portrayal, width, height, 500, 500)
+grid = LayeredCanvasGrid(agent_portrayal, width, height, 500, 500)
 
 server = ModularServer(CityModel, [grid], "Traffic Base", model_params)
 
@@ -0,0 +1,185 @@
+#sessions.py
+# Registry of the simulations served by flask_server.py and asgi_server.py,
+# one CityModel per session id, each with its own lock.
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from checkpoint import CheckpointError, load_checkpoint
+from model import CityModel
+from trajectory import TrajectoryReplay
+
+DEFAULT_SESSION = "default"  # Used by clients that do not send a session id
+# Checkpoints are read and written here only, clients pass a file name
+CHECKPOINT_DIR = 'checkpoints'
+# Recordings of trajectory.py served by /init?replay=<name>
+RECORDING_DIR = 'recordings'
+
+
+class InitError(Exception):
+    # /init parameters no model can be built from, with the HTTP status to answer
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def checkpoint_path(name):
+    name = os.path.basename(name)
+    return os.path.join(CHECKPOINT_DIR, name if name.endswith('.npz') else name + '.npz')
+
+
+def recording_path(name):
+    name = os.path.basename(name)
+    return os.path.join(RECORDING_DIR, name if name.endswith('.traj') else name + '.traj')
+
+
+def build_model(values, report=True):
+    """
+    Model for the parameters of an /init request, `values` maps names to
+    strings. `replay` serves a recording instead of running a model,
+    `checkpoint` resumes a run saved with /save, `demand` spawns from
+    city_files/demand/<name>.json and `warmup` fast-forwards that many steps.
+    `profile=1` turns on the step timers read from /metrics. With
+    report=False the model sends nothing to the metrics sink.
+    """
+    profile = values.get('profile') == '1'
+    replay = values.get('replay')
+    checkpoint = values.get('checkpoint')
+    if replay:
+        try:
+            model = TrajectoryReplay(recording_path(replay))
+        except FileNotFoundError:
+            raise InitError(f'No recording named {replay}.', 404)
+        except ValueError as error:
+            raise InitError(str(error), 400)
+    elif checkpoint:
+        try:
+            model = load_checkpoint(checkpoint_path(checkpoint), static_agents=False, profile=profile, report=report)
+        except FileNotFoundError:
+            raise InitError(f'No checkpoint named {checkpoint}.', 404)
+        except CheckpointError as error:
+            raise InitError(str(error), 400)
+    else:
+        demand = values.get('demand')
+        if demand:
+            demand = os.path.join('city_files', 'demand', os.path.basename(demand) + '.json')
+            if not os.path.exists(demand):
+                raise InitError(f'No demand file named {values["demand"]}.', 404)
+        model = CityModel(int(values.get('NAgents', 10)), static_agents=False, profile=profile,
+                          demand=demand or None, report=report)
+    model.fast_forward(int(values.get('warmup', 0)))
+    return model
+
+
+class Session:
+    def __init__(self, session_id, model, worker=None):
+        self.id = session_id
+        self.model = model
+        self.lock = threading.Lock()  # Held while the model steps
+        self.stream = None
+        self.worker = worker  # ModelWorker stepping the model, asgi_server.py only
+        self.last_used = time.monotonic()
+
+    def streaming(self):
+        return self.stream is not None and self.stream.running.is_set()
+
+    def stop_stream(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
+
+    def close(self):
+        # Once the registry dropped the session, the model goes with it
+        self.stop_stream()
+        if self.worker is not None:
+            # The worker closes the model it stepped
+            self.worker.stop()
+            self.worker = None
+        else:
+            # Not while a request is stepping it
+            with self.lock:
+                self.model.close()
+
+
+class SessionRegistry:
+    """
+    Live sessions in least recently used order. Sessions idle for more than
+    `ttl` seconds are evicted, as are the least recently used ones when there
+    are more than `max_sessions` or the sessions hold more than `max_cars`
+    live cars in total. Sessions that are streaming are never evicted.
+    Dropped sessions are passed to `closer`, which closes them on the
+    calling thread by default.
+    """
+    def __init__(self, max_sessions=16, ttl=600.0, max_cars=50000, closer=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_cars = max_cars
+        self.closer = closer or Session.close
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, model, session_id=None, worker=None):
+        # The session is visible as soon as it is in the registry, with its worker if it has one
+        session = Session(session_id or uuid.uuid4().hex, model, worker)
+        with self.lock:
+            old = self.sessions.pop(session.id, None)
+            self.sessions[session.id] = session
+            evicted = self.evict(keep=session.id)
+        if old is not None:
+            self.closer(old)
+        for other in evicted:
+            self.closer(other)
+        return session
+
+    def get(self, session_id):
+        with self.lock:
+            evicted = self.evict(keep=session_id)
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+                self.sessions.move_to_end(session_id)
+        for other in evicted:
+            self.closer(other)
+        return session
+
+    def remove(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.closer(session)
+        return session is not None
+
+    def live_cars(self):
+        return sum(session.model.active_agents for session in self.sessions.values())
+
+    def evict(self, keep=None):
+        # Called with self.lock held, returns the sessions to close
+        now = time.monotonic()
+        evicted = [session for session in self.sessions.values()
+                   if session.id != keep and not session.streaming() and now - session.last_used > self.ttl]
+        for session in evicted:
+            del self.sessions[session.id]
+        for session in list(self.sessions.values()):
+            if len(self.sessions) <= self.max_sessions and self.live_cars() <= self.max_cars:
+                break
+            if session.id != keep and not session.streaming():
+                del self.sessions[session.id]
+                evicted.append(session)
+        return evicted
+
+    def has_car_budget(self, session_id):
+        """
+        Whether `session_id` may keep stepping, evicting the least recently
+        used other sessions first if the car limit is exceeded.
+        """
+        with self.lock:
+            evicted = self.evict(keep=session_id)
+            within = self.live_cars() <= self.max_cars
+        for other in evicted:
+            self.closer(other)
+        return within
+
+    def __len__(self):
+        return len(self.sessions)
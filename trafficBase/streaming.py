@@ -0,0 +1,127 @@
+#streaming.py
+# Runs a CityModel on its own thread and pushes one frame per tick to every
+# subscriber, used by the /stream endpoints of flask_server.py.
+import json
+import threading
+import time
+from collections import deque
+
+
+def make_frame(model):
+    """
+    Compact frame of a tick: cars as [id, x, y] and lights as [id, state].
+    """
+    return {
+        "step": model.schedule.steps,
+        "cars": [[car["id"], car["x"], car["y"]] for car in model.get_agent_data()],
+        "lights": [[light.unique_id, light.state] for light in model.traffic_lights],
+    }
+
+
+class Subscriber:
+    """
+    Frames waiting for one consumer. The buffer is bounded, when a consumer
+    falls behind the oldest frames are dropped; every frame is a full state,
+    so the newest one replaces the ones it skipped.
+    """
+    def __init__(self, buffer_size):
+        self.frames = deque(maxlen=buffer_size)
+        self.ready = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, frame):
+        with self.ready:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(frame)
+            self.ready.notify()
+
+    def get(self, timeout=None):
+        with self.ready:
+            if not self.frames and not self.closed:
+                self.ready.wait(timeout)
+            return self.frames.popleft() if self.frames else None
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+
+class FrameStream:
+    """
+    Steps `model` at `tick_rate` ticks per second on a daemon thread, holding
+    `lock` while it steps so request handlers can share the model.
+    """
+    def __init__(self, model, lock, tick_rate=10.0, buffer_size=32):
+        self.model = model
+        self.lock = lock
+        self.tick_rate = tick_rate
+        self.buffer_size = buffer_size
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.running.set()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        # The thread closes the subscribers on its way out
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+
+    def subscribe(self):
+        # Once the stream stopped subscribers come closed, their events end at once
+        subscriber = Subscriber(self.buffer_size)
+        with self.subscribers_lock:
+            if self.running.is_set():
+                self.subscribers.append(subscriber)
+            else:
+                subscriber.close()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.subscribers_lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+        subscriber.close()
+
+    def run(self):
+        next_tick = time.monotonic()
+        while self.running.is_set() and self.model.running:
+            with self.lock:
+                self.model.step()
+                frame = json.dumps(make_frame(self.model), separators=(",", ":"))
+            with self.subscribers_lock:
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                subscriber.put(frame)
+            next_tick += 1.0 / self.tick_rate
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+        self.running.clear()
+        with self.subscribers_lock:
+            for subscriber in self.subscribers:
+                subscriber.close()
+            self.subscribers = []
+
+    def events(self, subscriber):
+        """
+        Server-sent events for a subscriber, ends when the stream stops.
+        """
+        try:
+            while True:
+                frame = subscriber.get(timeout=1.0)
+                if frame is None:
+                    if subscriber.closed:
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {frame}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
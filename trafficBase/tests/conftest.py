@@ -0,0 +1,13 @@
+# The tests import the flat modules of trafficBase/ and run from it, like its scripts
+import os
+import sys
+
+import pytest
+
+TRAFFIC_BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TRAFFIC_BASE)
+
+
+@pytest.fixture(autouse=True)
+def in_traffic_base(monkeypatch):
+    monkeypatch.chdir(TRAFFIC_BASE)
@@ -0,0 +1,13 @@
+import pytest
+
+from model import CityModel
+
+
+def test_step_after_close_raises():
+    model = CityModel(1, engine="partitioned", workers=1, report=False, static_agents=False, seed=0)
+    model.step()
+    model.close()
+    with pytest.raises(RuntimeError):
+        model.step()
+    with pytest.raises(RuntimeError):
+        model.get_agent_data()
@@ -0,0 +1,29 @@
+import threading
+
+import flask_server
+from sessions import SessionRegistry, build_model
+
+
+def test_closed_sessions_leave_no_threads():
+    registry = SessionRegistry()
+    before = threading.active_count()
+    for i in range(3):
+        registry.create(build_model({'NAgents': '1'}), f"session_{i}")
+    # Replacing a session closes the one it replaces
+    registry.create(build_model({'NAgents': '1'}), "session_0")
+    for i in range(3):
+        assert registry.remove(f"session_{i}")
+    assert len(registry) == 0
+    assert threading.active_count() == before
+
+
+def test_stopping_a_stream_keeps_the_session_model():
+    client = flask_server.app.test_client()
+    model = build_model({'NAgents': '1'})
+    flask_server.sessions.create(model, "streamed")
+    assert client.post('/stream/start', data={'session': "streamed", 'rate': 1000}).status_code == 200
+    assert client.post('/stream/stop', data={'session': "streamed"}).status_code == 200
+    assert client.get('/update?session=streamed').status_code == 200
+    assert model.metrics is not None
+    flask_server.sessions.remove("streamed")
+    assert model.metrics is None
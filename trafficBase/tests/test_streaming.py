@@ -0,0 +1,13 @@
+import threading
+
+from model import CityModel
+from streaming import FrameStream
+
+
+def test_subscribers_after_the_end_of_the_stream_are_closed():
+    model = CityModel(1, max_steps=2, report=False, static_agents=False, seed=0)
+    stream = FrameStream(model, threading.Lock(), tick_rate=1000)
+    stream.start()
+    stream.thread.join(5)
+    assert not model.running
+    assert list(stream.events(stream.subscribe())) == []
@@ -0,0 +1,351 @@
+#trajectory.py
+# Records a run tick by tick to a compact binary file and replays it without
+# the simulation, for the Unity viewer through flask_server.py
+# (/init?replay=<name>).
+#
+#   python trajectory.py record recordings/rush.traj --steps 2000 --engine array
+#   python trajectory.py info recordings/rush.traj
+#
+# The file is append-only: a JSON header with the map size and the lights,
+# then chunks of `chunk_ticks` ticks. A chunk stores its columns one after the
+# other, the car ids per tick, their moves since the previous tick as int16
+# dx/dy, the cars that arrived and the light states as bits. The first tick
+# of a chunk moves every car from (0, 0), so any chunk decodes on its own
+# and seeking only reads the chunk of the step asked for.
+import argparse
+import bisect
+import json
+import mmap
+import struct
+from types import SimpleNamespace
+
+import numpy as np
+
+MAGIC = b"TRAJ"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<4sII")  # Magic, version, header bytes
+CHUNK = struct.Struct("<4sIiiiii4x")  # Tag, payload bytes, first step, ticks, car rows, arrivals, largest car id
+CHUNK_TAG = b"CHNK"
+ALIGN = 8
+
+
+def car_number(car_id):
+    # "car_12" -> 12
+    return int(car_id[4:])
+
+
+def padded(data):
+    return data + b"\0" * (-len(data) % ALIGN)
+
+
+class TrajectoryWriter:
+    """
+    Appends the model's state to `path` every time record() is called,
+    usually once after every step. Ticks are written a chunk at a time,
+    close() writes the last partial chunk.
+    """
+    def __init__(self, path, model, chunk_ticks=64):
+        if max(model.width, model.height) > np.iinfo(np.int16).max:
+            raise ValueError("Maps wider or taller than 32767 cells don't fit int16 coordinates")
+        self.model = model
+        self.chunk_ticks = chunk_ticks
+        self.file = open(path, "wb")
+        header = json.dumps({
+            "width": model.width,
+            "height": model.height,
+            "chunk_ticks": chunk_ticks,
+            "map_key": model.compiled_map.key,
+            "params": model.params,
+            "lights": [[light.unique_id, light.pos[0], light.pos[1]] for light in model.traffic_lights],
+        }).encode()
+        self.file.write(padded(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)) + header))
+        self.ticks = []
+        self.previous_ids = None  # Cars of the last tick written
+
+    def record(self):
+        model = self.model
+        cars = model.get_agent_data()
+        ids = np.fromiter((car_number(car["id"]) for car in cars), dtype=np.int32, count=len(cars))
+        x = np.fromiter((car["x"] for car in cars), dtype=np.int16, count=len(cars))
+        y = np.fromiter((car["y"] for car in cars), dtype=np.int16, count=len(cars))
+        lights = np.packbits(np.fromiter((light.state for light in model.traffic_lights), dtype=bool,
+                                         count=len(model.traffic_lights)))
+        self.ticks.append((model.schedule.steps, ids, x, y, lights, model.active_agents, model.arrived_agents))
+        if len(self.ticks) == self.chunk_ticks:
+            self.write_chunk()
+
+    def write_chunk(self):
+        steps, ids, xs, ys, lights, active, arrived_total = zip(*self.ticks)
+        self.ticks = []
+        largest = max((int(tick_ids.max()) for tick_ids in ids if len(tick_ids)), default=-1)
+        last_x = np.zeros(largest + 1, dtype=np.int16)
+        last_y = np.zeros(largest + 1, dtype=np.int16)
+        present = np.zeros(largest + 1, dtype=bool)
+        dx, dy, arrivals, arrival_counts = [], [], [], []
+        for tick_ids, x, y in zip(ids, xs, ys):
+            # Cars gone since the previous tick arrived
+            now = np.zeros(largest + 1, dtype=bool)
+            now[tick_ids] = True
+            gone = np.flatnonzero(present & ~now).astype(np.int32)
+            arrivals.append(gone)
+            arrival_counts.append(len(gone))
+            # New cars have last position (0, 0), their delta is the position
+            last_x[~present] = 0
+            last_y[~present] = 0
+            dx.append(x - last_x[tick_ids])
+            dy.append(y - last_y[tick_ids])
+            last_x[tick_ids] = x
+            last_y[tick_ids] = y
+            present = now
+        # The first tick of a chunk can't tell arrivals from the previous chunk
+        arrivals[0] = self.carried_arrivals(ids[0])
+        arrival_counts[0] = len(arrivals[0])
+        self.previous_ids = ids[-1]
+
+        columns = [np.array(steps, dtype=np.int32), np.array([len(tick_ids) for tick_ids in ids], dtype=np.int32),
+                   np.array(arrival_counts, dtype=np.int32), np.array(active, dtype=np.int32),
+                   np.array(arrived_total, dtype=np.int32), np.concatenate(ids), np.concatenate(dx),
+                   np.concatenate(dy), np.concatenate(arrivals), np.stack(lights)]
+        payload = b"".join(padded(column.tobytes()) for column in columns)
+        rows = sum(len(tick_ids) for tick_ids in ids)
+        self.file.write(CHUNK.pack(CHUNK_TAG, len(payload), steps[0], len(steps), rows, sum(arrival_counts), largest))
+        self.file.write(payload)
+        self.file.flush()
+
+    def carried_arrivals(self, ids):
+        if self.previous_ids is None:
+            return np.zeros(0, dtype=np.int32)
+        return np.setdiff1d(self.previous_ids, ids).astype(np.int32)
+
+    def close(self):
+        if self.ticks:
+            self.write_chunk()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TrajectoryReader:
+    """
+    Memory-maps a recording and decodes the ticks asked for, one chunk at a
+    time. A chunk cut short by a crashed recorder is ignored.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_size = PREAMBLE.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a trajectory recording")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{path} has recording format {version}, this code reads {FORMAT_VERSION}")
+        self.header = json.loads(self.mmap[PREAMBLE.size:PREAMBLE.size + header_size])
+        self.lights = self.header["lights"]
+        self.chunks = []  # (first step, offset of the chunk header)
+        offset = PREAMBLE.size + header_size + (-(PREAMBLE.size + header_size) % ALIGN)
+        while offset + CHUNK.size <= len(self.mmap):
+            tag, payload, first_step, *_ = CHUNK.unpack_from(self.mmap, offset)
+            if tag != CHUNK_TAG or offset + CHUNK.size + payload > len(self.mmap):
+                break
+            self.chunks.append((first_step, offset))
+            offset += CHUNK.size + payload
+        self.first_steps = [first_step for first_step, _ in self.chunks]
+        self.cached = None  # (chunk index, decoded chunk)
+
+    def close(self):
+        self.cached = None
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Frames handed out still use the pages, the mapping goes with them
+            pass
+
+    def steps(self):
+        # First and last recorded steps, None for an empty recording
+        if not self.chunks:
+            return None
+        return self.first_steps[0], int(self.chunk(len(self.chunks) - 1)["steps"][-1])
+
+    def columns(self, offset):
+        _, _, _, ticks, rows, arrivals, largest = CHUNK.unpack_from(self.mmap, offset)
+        offset += CHUNK.size
+        light_bytes = (len(self.lights) + 7) // 8
+        layout = [("steps", np.int32, ticks), ("counts", np.int32, ticks), ("arrival_counts", np.int32, ticks),
+                  ("active", np.int32, ticks), ("arrived_total", np.int32, ticks), ("ids", np.int32, rows),
+                  ("dx", np.int16, rows), ("dy", np.int16, rows), ("arrivals", np.int32, arrivals),
+                  ("lights", np.uint8, ticks * light_bytes)]
+        columns = {}
+        for name, dtype, size in layout:
+            columns[name] = np.frombuffer(self.mmap, dtype=dtype, count=size, offset=offset)
+            offset += -(-size * np.dtype(dtype).itemsize // ALIGN) * ALIGN
+        columns["lights"] = columns["lights"].reshape(ticks, light_bytes)
+        columns["largest"] = largest
+        return columns
+
+    def chunk(self, index):
+        """
+        Chunk `index` with absolute positions, x and y line up with ids.
+        """
+        if self.cached is not None and self.cached[0] == index:
+            return self.cached[1]
+        columns = self.columns(self.chunks[index][1])
+        ids = columns["ids"]
+        x = np.empty(len(ids), dtype=np.int16)
+        y = np.empty(len(ids), dtype=np.int16)
+        last_x = np.zeros(columns["largest"] + 1, dtype=np.int16)
+        last_y = np.zeros(columns["largest"] + 1, dtype=np.int16)
+        present = np.zeros(columns["largest"] + 1, dtype=bool)
+        ends = np.cumsum(columns["counts"])
+        for start, end in zip(ends - columns["counts"], ends):
+            tick_ids = ids[start:end]
+            now = np.zeros_like(present)
+            now[tick_ids] = True
+            last_x[~present] = 0
+            last_y[~present] = 0
+            x[start:end] = last_x[tick_ids] + columns["dx"][start:end]
+            y[start:end] = last_y[tick_ids] + columns["dy"][start:end]
+            last_x[tick_ids] = x[start:end]
+            last_y[tick_ids] = y[start:end]
+            present = now
+        columns.update(x=x, y=y, ends=ends, arrival_ends=np.cumsum(columns["arrival_counts"]))
+        self.cached = (index, columns)
+        return columns
+
+    def frame(self, step):
+        """
+        The recorded tick at `step`, or the last one before it.
+        """
+        index = max(bisect.bisect_right(self.first_steps, step) - 1, 0)
+        chunk = self.chunk(index)
+        tick = max(int(np.searchsorted(chunk["steps"], step, side="right")) - 1, 0)
+        start, end = chunk["ends"][tick] - chunk["counts"][tick], chunk["ends"][tick]
+        arrival_end = chunk["arrival_ends"][tick]
+        return {
+            "step": int(chunk["steps"][tick]),
+            "ids": chunk["ids"][start:end],
+            "x": chunk["x"][start:end],
+            "y": chunk["y"][start:end],
+            "arrived": chunk["arrivals"][arrival_end - chunk["arrival_counts"][tick]:arrival_end],
+            "lights": np.unpackbits(chunk["lights"][tick], count=len(self.lights)).astype(bool),
+            "active_agents": int(chunk["active"][tick]),
+            "arrived_agents": int(chunk["arrived_total"][tick]),
+        }
+
+
+class TrajectoryReplay:
+    """
+    Stands in for a CityModel in a flask_server session: step() moves to the
+    next recorded tick and seek() to any step, get_agent_data() and
+    get_semaphores() answer from the recording. Nothing is simulated.
+    """
+    profiler = None
+
+    def __init__(self, path):
+        self.reader = TrajectoryReader(path)
+        if self.reader.steps() is None:
+            raise ValueError(f"{path} holds no ticks")
+        self.first_step, self.last_step = self.reader.steps()
+        self.width, self.height = self.reader.header["width"], self.reader.header["height"]
+        self.schedule = SimpleNamespace(steps=self.first_step)
+        self.traffic_lights = [SimpleNamespace(unique_id=light_id, pos=(x, y), state=False)
+                               for light_id, x, y in self.reader.lights]
+        self.seek(self.first_step)
+
+    def seek(self, step):
+        step = min(max(step, self.first_step), self.last_step)
+        self.current = self.reader.frame(step)
+        self.schedule.steps = self.current["step"]
+        for light, state in zip(self.traffic_lights, self.current["lights"].tolist()):
+            light.state = state
+        self.active_agents = self.current["active_agents"]
+        self.arrived_agents = self.current["arrived_agents"]
+        self.running = self.schedule.steps < self.last_step
+
+    def step(self):
+        if self.running:
+            self.seek(self.schedule.steps + 1)
+
+    def fast_forward(self, n_steps):
+        self.seek(self.schedule.steps + n_steps)
+
+    def get_agent_data(self):
+        frame = self.current
+        return [{"id": f"car_{number}", "x": x, "y": y, "arrived": False}
+                for number, x, y in zip(frame["ids"].tolist(), frame["x"].tolist(), frame["y"].tolist())]
+
+    def get_semaphores(self):
+        return [{"id": light.unique_id, "x": light.pos[0], "y": light.pos[1], "state": light.state}
+                for light in self.traffic_lights]
+
+    # Delta clients of /step always get full frames from a replay
+    def enable_change_tracking(self, history=100):
+        pass
+
+    def get_changes_since(self, step):
+        return None
+
+    def close(self):
+        # The decoded arrays are views of the file
+        self.current = None
+        self.reader.close()
+
+
+def record(model, path, steps, chunk_ticks=64):
+    """
+    Steps `model` up to `steps` times, recording the state it starts from
+    and every tick after it.
+    """
+    with TrajectoryWriter(path, model, chunk_ticks) as writer:
+        writer.record()
+        for _ in range(steps):
+            if not model.running:
+                break
+            model.step()
+            writer.record()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record runs for replay and inspect recordings.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="run a model headless and record it")
+    record_parser.add_argument("out")
+    record_parser.add_argument("--steps", type=int, default=1000)
+    record_parser.add_argument("--map", default="2023_base")
+    record_parser.add_argument("--engine", default="mesa", choices=["mesa", "array", "partitioned"])
+    record_parser.add_argument("--spawn-every", type=int, default=3)
+    record_parser.add_argument("--light-plan", default=None)
+    record_parser.add_argument("--demand", default=None, help="demand file, see demand.py")
+    record_parser.add_argument("--checkpoint", help="start from this checkpoint instead of a new model")
+    record_parser.add_argument("--seed", type=int, default=None)
+    info_parser = commands.add_parser("info", help="describe a recording")
+    info_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        from checkpoint import load_checkpoint
+        from model import CityModel
+        if args.checkpoint:
+            model = load_checkpoint(args.checkpoint, report=False, static_agents=False,
+                                    max_steps=None)
+        else:
+            model = CityModel(1, engine=args.engine, map_file=f"city_files/{args.map}.txt",
+                              spawn_every=args.spawn_every, light_plan=args.light_plan, demand=args.demand, max_steps=None,
+                              report=False, static_agents=False, seed=args.seed)
+        try:
+            record(model, args.out, args.steps)
+        finally:
+            model.close()
+        print(f"Recorded steps up to {model.schedule.steps} to {args.out}")
+    else:
+        reader = TrajectoryReader(args.path)
+        steps = reader.steps()
+        print(f"{reader.header['width']}x{reader.header['height']} map, {len(reader.lights)} lights, "
+              f"{len(reader.chunks)} chunks of {reader.header['chunk_ticks']} ticks, steps {steps}")
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()